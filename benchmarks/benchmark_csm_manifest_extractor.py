@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# (C) Copyright [2023] Hewlett Packard Enterprise Development LP
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Benchmark csm_manifest_extractor.py against a synthetic CSM repo, with helm charts served from a local HTTP server
+# standing in for artifactory. Nothing is fetched from Github or artifactory, so this can be run offline.
+#
+# For each combination of branch and chart counts the wall time, peak RSS (of the extractor and everything it ran) and
+# the number of git and helm processes started are measured.
+#
+# Requires git and helm to be installed. Example:
+#   ./benchmarks/benchmark_csm_manifest_extractor.py --branches 4,16 --charts 10,40 --warm --output results.json
+
+import argparse
+import functools
+import hashlib
+import http.server
+import io
+import itertools
+import json
+import os
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+import yaml
+
+extractor_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "csm_manifest_extractor.py")
+
+registry = "artifactory.algol60.net/csm-docker/stable"
+lookup_images = ["hms-shcd-parser", "hms-trs-worker-http-v1"]
+
+deployment_template = """---
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: {{ .Chart.Name }}
+spec:
+  template:
+    spec:
+      initContainers:
+        - name: wait-for-postgres
+          image: "docker.io/library/busybox:1.28"
+      containers:
+        - name: {{ .Chart.Name }}
+          image: "{{ .Values.image.repository }}:{{ .Values.global.appVersion }}"
+"""
+
+test_template = """---
+apiVersion: v1
+kind: Pod
+metadata:
+  name: {{ .Chart.Name }}-test
+  annotations:
+    "helm.sh/hook": test
+spec:
+  containers:
+    - name: tests
+      image: "{{ .Values.tests.image.repository }}:{{ .Values.global.testVersion }}"
+"""
+
+
+def chart_name(chart_index):
+    return f'cray-hms-synthetic-{chart_index:03d}'
+
+
+def chart_version(branch_index, branches_per_chart_version):
+    # Neighbouring release branches usually share chart versions
+    return f'1.{branch_index // branches_per_chart_version}.0'
+
+
+def build_chart(name, version):
+    short_name = name.replace("cray-hms-", "cray-")
+    files = {
+        "Chart.yaml": yaml.dump({
+            "apiVersion": "v2",
+            "name": name,
+            "version": version,
+            "sources": [f'https://github.com/Cray-HPE/hms-{name.removeprefix("cray-hms-")}']
+        }),
+        "values.yaml": yaml.dump({
+            "global": {"appVersion": version, "testVersion": version},
+            "image": {"repository": f'{registry}/{short_name}'},
+            "tests": {"image": {"repository": f'{registry}/{short_name}-hmth-test'}}
+        }),
+        "templates/deployment.yaml": deployment_template,
+        "templates/tests.yaml": test_template,
+    }
+
+    chart_data = io.BytesIO()
+    with tarfile.open(fileobj=chart_data, mode="w:gz") as chart_tarball:
+        for file_name, content in files.items():
+            content = content.encode()
+            member = tarfile.TarInfo(f'{name}/{file_name}')
+            member.size = len(content)
+            chart_tarball.addfile(member, io.BytesIO(content))
+
+    return chart_data.getvalue()
+
+
+def build_chart_repo(chart_repo_dir, branch_count, chart_count, branches_per_chart_version):
+    index = {"apiVersion": "v1", "entries": {}}
+    for chart_index in range(chart_count):
+        name = chart_name(chart_index)
+        os.makedirs(os.path.join(chart_repo_dir, name))
+
+        versions = sorted({chart_version(branch_index, branches_per_chart_version) for branch_index in range(branch_count)})
+        for version in versions:
+            chart_data = build_chart(name, version)
+            chart_path = f'{name}/{name}-{version}.tgz'
+            with open(os.path.join(chart_repo_dir, chart_path), 'wb') as f:
+                f.write(chart_data)
+
+            index["entries"].setdefault(name, []).append({
+                "apiVersion": "v2",
+                "name": name,
+                "version": version,
+                "digest": hashlib.sha256(chart_data).hexdigest(),
+                "urls": [chart_path]
+            })
+
+    with open(os.path.join(chart_repo_dir, "index.yaml"), 'w') as f:
+        yaml.dump(index, f)
+
+
+def git(repo_dir, *args):
+    subprocess.run(["git", *args], cwd=repo_dir, check=True, capture_output=True)
+
+
+def build_csm_repo(csm_repo_dir, chart_repo_url, branch_count, chart_count, manifest_count, docker_image_count, branches_per_chart_version):
+    os.makedirs(csm_repo_dir)
+    git(csm_repo_dir, "init", "-q", "-b", "main")
+    git(csm_repo_dir, "config", "user.name", "benchmark")
+    git(csm_repo_dir, "config", "user.email", "benchmark@localhost")
+    # Allow the extractor to make a partial clone
+    git(csm_repo_dir, "config", "uploadpack.allowFilter", "true")
+    os.makedirs(os.path.join(csm_repo_dir, "docker"))
+    os.makedirs(os.path.join(csm_repo_dir, "manifests"))
+
+    branches = ["main"] + [f'release/1.{branch_index}' for branch_index in range(1, branch_count)]
+    for branch_index, branch in enumerate(branches):
+        if branch != "main":
+            git(csm_repo_dir, "checkout", "-q", "-B", branch, "main")
+
+        images = {image: [f'1.{branch_index}.0', f'1.{branch_index}.1'] for image in lookup_images}
+        for image_index in range(docker_image_count):
+            images[f'synthetic-image-{image_index:04d}'] = [f'0.{branch_index}.0']
+        with open(os.path.join(csm_repo_dir, "docker", "index.yaml"), 'w') as f:
+            yaml.dump({registry: {"images": images}}, f)
+
+        # Spread the charts across the manifests, along with a chart that doesn't match the target chart regex
+        for manifest_index in range(manifest_count):
+            charts = [{"name": f'unrelated-chart-{manifest_index}', "source": "csm-algol60", "version": "0.1.0"}]
+            for chart_index in range(manifest_index, chart_count, manifest_count):
+                charts.append({
+                    "name": chart_name(chart_index),
+                    "source": "csm-algol60",
+                    "version": chart_version(branch_index, branches_per_chart_version),
+                    "values": {"global": {"appVersion": chart_version(branch_index, branches_per_chart_version)}}
+                })
+
+            manifest = {
+                "apiVersion": "manifests/v1beta1",
+                "metadata": {"name": f'synthetic-{manifest_index}'},
+                "spec": {
+                    "sources": {"charts": [{"name": "csm-algol60", "type": "repo", "location": chart_repo_url}]},
+                    "charts": charts
+                }
+            }
+            with open(os.path.join(csm_repo_dir, "manifests", f'synthetic-{manifest_index}.yaml'), 'w') as f:
+                yaml.dump(manifest, f)
+
+        git(csm_repo_dir, "add", "-A")
+        git(csm_repo_dir, "commit", "-q", "-m", f'Synthetic {branch}')
+        if branch != "main":
+            git(csm_repo_dir, "tag", f'v1.{branch_index}.0')
+
+    git(csm_repo_dir, "checkout", "-q", "main")
+    return branches
+
+
+def write_extractor_config(config_path, branches):
+    config = {
+        "github-repo-image-lookup": [{"github-repo": image, "image": image} for image in lookup_images],
+        "configuration": {
+            "manifest-repo": "csm",
+            "targeted-csm-branches": branches,
+            "docker-image-manifest": "docker/index.yaml",
+            "helm-manifest-directory": "manifests",
+            "target-chart-regex": "cray-hms-.*",
+            "log-level": "WARNING"
+        }
+    }
+    with open(config_path, 'w') as f:
+        yaml.dump(config, f)
+
+
+def write_counting_shims(shim_dir, commands):
+    # Put a wrapper for each command on the PATH, that records each time it is started in $BENCHMARK_COUNT_DIR before
+    # running the real one
+    os.makedirs(shim_dir)
+    for command in commands:
+        command_path = shutil.which(command)
+        if command_path is None:
+            print(f'{command} is required to run the benchmark')
+            exit(1)
+
+        shim_path = os.path.join(shim_dir, command)
+        with open(shim_path, 'w') as f:
+            f.write(f'#!/bin/sh\necho >> "$BENCHMARK_COUNT_DIR/{command}"\nexec "{command_path}" "$@"\n')
+        os.chmod(shim_path, 0o755)
+
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+class QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def run_extractor(run_dir, shim_dir, extractor_args):
+    count_dir = os.path.join(run_dir, "process-counts")
+    shutil.rmtree(count_dir, ignore_errors=True)
+    os.makedirs(count_dir)
+
+    env = dict(os.environ)
+    env["PATH"] = shim_dir + os.pathsep + env["PATH"]
+    env["BENCHMARK_COUNT_DIR"] = count_dir
+    env["ARTIFACTORY_ALGOL60_READONLY_USERNAME"] = "benchmark"
+    env["ARTIFACTORY_ALGOL60_READONLY_TOKEN"] = "benchmark"
+    env.pop("LOG_LEVEL", None)
+
+    start = time.perf_counter()
+    with open(os.path.join(run_dir, "csm_manifest_extractor.log"), 'a') as log:
+        process = subprocess.Popen([sys.executable, extractor_path, *extractor_args], cwd=run_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 reports the peak RSS of the extractor, or the largest of the processes it waited on (such as helm)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.perf_counter() - start
+
+    if process.returncode != 0:
+        print(f'csm_manifest_extractor.py failed with exit code {process.returncode}, see {os.path.join(run_dir, "csm_manifest_extractor.log")}')
+        exit(1)
+
+    return {
+        "wall-time": wall_time,
+        "peak-rss-mb": rusage.ru_maxrss / 1024,
+        "git-processes": count_lines(os.path.join(count_dir, "git")),
+        "helm-processes": count_lines(os.path.join(count_dir, "helm"))
+    }
+
+
+def run_scenario(work_dir, args, branch_count, chart_count):
+    scenario_dir = os.path.join(work_dir, f'branches-{branch_count}-charts-{chart_count}')
+    chart_repo_dir = os.path.join(scenario_dir, "chart-repo")
+    os.makedirs(chart_repo_dir)
+
+    build_chart_repo(chart_repo_dir, branch_count, chart_count, args.branches_per_chart_version)
+
+    # Serve the charts from a random free port, standing in for artifactory
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHTTPRequestHandler, directory=chart_repo_dir))
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    try:
+        chart_repo_url = f'http://127.0.0.1:{server.server_address[1]}/'
+
+        csm_repo_dir = os.path.join(scenario_dir, "csm-origin")
+        branches = build_csm_repo(csm_repo_dir, chart_repo_url, branch_count, chart_count, args.manifests, args.docker_images, args.branches_per_chart_version)
+
+        shim_dir = os.path.join(scenario_dir, "bin")
+        write_counting_shims(shim_dir, ["git", "helm"])
+
+        results = []
+        for repeat in range(args.repeat):
+            run_dir = os.path.join(scenario_dir, f'run-{repeat}')
+            os.makedirs(run_dir)
+            write_extractor_config(os.path.join(run_dir, "csm-manifest-extractor-configuration.yaml"), branches)
+
+            extractor_args = ["--manifest-repo-url", "file://" + csm_repo_dir] + shlex.split(args.extractor_args)
+            runs = ["cold"]
+            if args.warm:
+                # The second run reuses the cache directory populated by the first
+                extractor_args += ["--cache-dir", os.path.join(run_dir, "cache")]
+                runs.append("warm")
+
+            for run in runs:
+                result = run_extractor(run_dir, shim_dir, extractor_args)
+                result.update({"branches": branch_count, "charts": chart_count, "run": run, "repeat": repeat})
+                results.append(result)
+                print("branches={branches} charts={charts} run={run} wall-time={wall-time:.2f}s peak-rss={peak-rss-mb:.1f}MB git={git-processes} helm={helm-processes}".format(**result))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return results
+
+
+def summarize(results):
+    # Take the median of each measurement across the repeats
+    groups = {}
+    for result in results:
+        groups.setdefault((result["branches"], result["charts"], result["run"]), []).append(result)
+
+    summary = []
+    for key, group in groups.items():
+        summary.append({
+            "branches": key[0],
+            "charts": key[1],
+            "run": key[2],
+            "wall-time": statistics.median(result["wall-time"] for result in group),
+            "peak-rss-mb": statistics.median(result["peak-rss-mb"] for result in group),
+            "git-processes": statistics.median(result["git-processes"] for result in group),
+            "helm-processes": statistics.median(result["helm-processes"] for result in group)
+        })
+    return summary
+
+
+def print_summary(summary):
+    print()
+    print("{:>8} {:>6} {:>5} {:>12} {:>14} {:>6} {:>6}".format("branches", "charts", "run", "wall time (s)", "peak RSS (MB)", "git", "helm"))
+    for row in summary:
+        print("{branches:>8} {charts:>6} {run:>5} {wall-time:>12.2f} {peak-rss-mb:>14.1f} {git-processes:>6g} {helm-processes:>6g}".format(**row))
+
+
+if __name__ == '__main__':
+    #
+    # Parse CLI flags
+    #
+    parser = argparse.ArgumentParser(description="Benchmark csm_manifest_extractor.py against a synthetic CSM repo and a local helm chart server")
+    parser.add_argument("--branches", type=str, default="4,16", help="Comma separated list of the number of CSM branches to benchmark with")
+    parser.add_argument("--charts", type=str, default="10,40", help="Comma separated list of the number of HMS helm charts to benchmark with")
+    parser.add_argument("--manifests", type=int, default=4, help="Number of loftsman manifests the helm charts are spread across in each branch")
+    parser.add_argument("--docker-images", type=int, default=500, help="Number of unrelated images in the docker/index.yaml of each branch")
+    parser.add_argument("--branches-per-chart-version", type=int, default=2, help="Number of neighbouring branches that reference the same version of each chart")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times to run each benchmark, the median is reported")
+    parser.add_argument("--warm", type=bool, default=False, action=argparse.BooleanOptionalAction, help="Run the extractor a second time with the --cache-dir from the first run, to measure a warm run")
+    parser.add_argument("--extractor-args", type=str, default="", help="Extra arguments to pass to csm_manifest_extractor.py")
+    parser.add_argument("--work-dir", type=str, default=None, help="Directory to generate the synthetic repos in. Defaults to a temporary directory that is removed afterwards")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this file, so they can be tracked over time")
+
+    args = parser.parse_args()
+
+    #
+    # Run the benchmarks
+    #
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="csm-manifest-extractor-benchmark-")
+    elif os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+
+    try:
+        results = []
+        for branch_count, chart_count in itertools.product([int(e) for e in args.branches.split(",")], [int(e) for e in args.charts.split(",")]):
+            results.extend(run_scenario(work_dir, args, branch_count, chart_count))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    summary = summarize(results)
+    print_summary(summary)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "extractor-args": args.extractor_args,
+                "results": results,
+                "summary": summary
+            }, f, indent=2)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+# MIT License
+#
+# (C) Copyright [2023] Hewlett Packard Enterprise Development LP
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# SQLite store for the images of each CSM release, as found by csm_manifest_extractor.py and
+# gather_bleeding_edge_images.py. It holds the same data as csm-manifest-extractor-output.json, but a single release
+# can be looked up without parsing everything, and writing a release only replaces that release. Each release records
+# the script that wrote it, so each script only ever removes its own releases. Every version of a release that was
+# written is also kept in release_history.
+#
+# It can also be run directly to import JSON output files into a database:
+#   ./csm_image_store.py --db csm-images.db csm-manifest-extractor-output.json bleeding-edge-image-versions.json
+
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+
+schema = """
+CREATE TABLE IF NOT EXISTS release (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    updated_at TEXT NOT NULL,
+    source TEXT
+);
+
+CREATE TABLE IF NOT EXISTS image_repo (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+-- position keeps the images and tags of a release in the order they were written
+CREATE TABLE IF NOT EXISTS tag (
+    release_id INTEGER NOT NULL REFERENCES release(id) ON DELETE CASCADE,
+    image_repo_id INTEGER NOT NULL REFERENCES image_repo(id),
+    tag TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (release_id, image_repo_id, tag)
+);
+
+CREATE INDEX IF NOT EXISTS tag_by_image_repo ON tag(image_repo_id);
+
+CREATE TABLE IF NOT EXISTS git_sha (
+    release_id INTEGER PRIMARY KEY REFERENCES release(id) ON DELETE CASCADE,
+    sha TEXT
+);
+
+CREATE TABLE IF NOT EXISTS git_tags (
+    release_id INTEGER NOT NULL REFERENCES release(id) ON DELETE CASCADE,
+    tag TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (release_id, tag)
+);
+
+-- One row for every time a release was written or removed. release is the JSON of the release as it was written, or
+-- NULL when it was removed.
+CREATE TABLE IF NOT EXISTS release_history (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    source TEXT,
+    written_at TEXT NOT NULL,
+    release TEXT
+);
+
+CREATE INDEX IF NOT EXISTS release_history_by_name ON release_history(name, id);
+"""
+
+
+def open_store(db_path):
+    connection = sqlite3.connect(db_path)
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.executescript(schema)
+
+    # Databases created before releases recorded their source
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(release)")]
+    if "source" not in columns:
+        connection.execute("ALTER TABLE release ADD COLUMN source TEXT")
+
+    return connection
+
+
+def write_release(connection, release_name, release, source=None):
+    # Replace everything known about the release. release is in the same format as each release in
+    # csm-manifest-extractor-output.json: {"images": {image repo: [tags]}, "git_sha": ..., "git_tags": [...]}
+    written_at = datetime.datetime.utcnow().isoformat() + "Z"
+    connection.execute("DELETE FROM release WHERE name = ?", (release_name,))
+    release_id = connection.execute(
+        "INSERT INTO release (name, updated_at, source) VALUES (?, ?, ?)",
+        (release_name, written_at, source)
+    ).lastrowid
+    connection.execute(
+        "INSERT INTO release_history (name, source, written_at, release) VALUES (?, ?, ?, ?)",
+        (release_name, source, written_at, json.dumps(release))
+    )
+
+    position = 0
+    for image_repo, tags in release["images"].items():
+        connection.execute("INSERT OR IGNORE INTO image_repo (name) VALUES (?)", (image_repo,))
+        image_repo_id = connection.execute("SELECT id FROM image_repo WHERE name = ?", (image_repo,)).fetchone()[0]
+        for tag in tags:
+            connection.execute("INSERT OR IGNORE INTO tag (release_id, image_repo_id, tag, position) VALUES (?, ?, ?, ?)", (release_id, image_repo_id, tag, position))
+            position += 1
+
+    connection.execute("INSERT INTO git_sha (release_id, sha) VALUES (?, ?)", (release_id, release.get("git_sha")))
+    for position, git_tag in enumerate(release.get("git_tags", [])):
+        connection.execute("INSERT OR IGNORE INTO git_tags (release_id, tag, position) VALUES (?, ?, ?)", (release_id, git_tag, position))
+
+
+def write_releases(db_path, images_by_csm_release, source=None, prune=False):
+    # All of the releases are written in a single transaction, so readers see either all of them or none of them. With
+    # prune any release previously written by the same source that is not in images_by_csm_release is removed, such as
+    # a CSM branch that is no longer targeted. Releases of other sources are left alone.
+    connection = open_store(db_path)
+    try:
+        with connection:
+            if prune:
+                for release_name, in connection.execute("SELECT name FROM release WHERE source = ?", (source,)).fetchall():
+                    if release_name not in images_by_csm_release:
+                        connection.execute("DELETE FROM release WHERE name = ?", (release_name,))
+                        connection.execute(
+                            "INSERT INTO release_history (name, source, written_at, release) VALUES (?, ?, ?, NULL)",
+                            (release_name, source, datetime.datetime.utcnow().isoformat() + "Z")
+                        )
+
+            for release_name, release in images_by_csm_release.items():
+                write_release(connection, release_name, release, source)
+    finally:
+        connection.close()
+
+
+def read_release(connection, release_name):
+    row = connection.execute("SELECT id FROM release WHERE name = ?", (release_name,)).fetchone()
+    if row is None:
+        return None
+    release_id = row[0]
+
+    images = {}
+    for image_repo, tag in connection.execute(
+            "SELECT image_repo.name, tag.tag FROM tag JOIN image_repo ON image_repo.id = tag.image_repo_id WHERE tag.release_id = ? ORDER BY tag.position",
+            (release_id,)):
+        images.setdefault(image_repo, []).append(tag)
+
+    git_sha = connection.execute("SELECT sha FROM git_sha WHERE release_id = ?", (release_id,)).fetchone()
+    git_tags = [row[0] for row in connection.execute("SELECT tag FROM git_tags WHERE release_id = ? ORDER BY position", (release_id,))]
+
+    return {
+        "images": images,
+        "git_sha": git_sha[0] if git_sha is not None else None,
+        "git_tags": git_tags
+    }
+
+
+def list_releases(connection):
+    return [row[0] for row in connection.execute("SELECT name FROM release ORDER BY id")]
+
+
+def read_release_history(connection, release_name):
+    # Every version of the release that was written, oldest first. release is None for when it was removed.
+    return [
+        {"written_at": written_at, "source": source, "release": json.loads(release) if release is not None else None}
+        for written_at, source, release in connection.execute(
+            "SELECT written_at, source, release FROM release_history WHERE name = ? ORDER BY id", (release_name,))
+    ]
+
+
+def load_release(csm_release, csm_extractor_output_json=None, csm_extractor_output_db=None):
+    # Look up a single CSM release from either the database or the JSON file created by csm_manifest_extractor.py. The
+    # database is preferred when both are given. Returns None when the release does not exist.
+    if csm_extractor_output_db is not None:
+        if not os.path.exists(csm_extractor_output_db):
+            return None
+
+        connection = sqlite3.connect(f'file:{csm_extractor_output_db}?mode=ro', uri=True)
+        try:
+            return read_release(connection, csm_release)
+        finally:
+            connection.close()
+
+    with open(csm_extractor_output_json, 'r') as f:
+        csm_extractor_output = json.load(f)
+
+    return csm_extractor_output.get(csm_release)
+
+
+if __name__ == "__main__":
+    #
+    # Parse CLI flags
+    #
+    parser = argparse.ArgumentParser(description="Import csm_manifest_extractor.py JSON output files into a SQLite database")
+    parser.add_argument("--db", type=str, default="csm-manifest-extractor-output.db", help="SQLite database to write to")
+    parser.add_argument("--source", type=str, default=None, help="Record the releases as written by this source, such as csm_manifest_extractor or gather_bleeding_edge_images")
+    parser.add_argument("json_files", type=str, nargs="+", help="JSON files in the csm-manifest-extractor-output.json format. Releases in later files replace earlier ones")
+
+    args = parser.parse_args()
+
+    for json_file in args.json_files:
+        with open(json_file, 'r') as f:
+            images_by_csm_release = json.load(f)
+
+        print(f'Importing {", ".join(images_by_csm_release.keys())} from {json_file} into {args.db}')
+        write_releases(args.db, images_by_csm_release, source=args.source)
@@ -22,46 +22,1234 @@
 # ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import argparse
+import atexit
 import collections
+import concurrent.futures
+import contextlib
 import copy
 from datetime import datetime, timedelta
+import fnmatch
+import functools
 import glob
+import hashlib
 import json
 import logging
 import os
+import queue
 import re
+import shlex
 import shutil
 import tarfile
+import tempfile
+import threading
 import time
 from urllib.parse import urljoin
 
-from deepdiff import DeepDiff
 from git import Repo
 from github import Github
 import requests
+import requests.adapters
 import yaml
 import subprocess
 import urllib
 import git
 
-def GetDockerImageFromDiff(value, tag):
-    # example: root['artifactory.algol60.net/csm-docker/stable']['images']['hms-trs-worker-http-v1'][0]
-    values = value.split(']')
-    image = values[2]
-    image = image.replace('[', '')
-    image = image.replace('\'', '')
-    return 'artifactory.algol60.net/csm-docker/stable/' + image + ':' + tag
+import csm_image_store
 
+# Use the much faster libyaml based loader when PyYAML was built with it
+YAMLLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+class Tracer:
+    # Records how long each part of the extraction takes as spans, which can be written out in the Chrome trace event
+    # format and loaded into chrome://tracing or https://ui.perfetto.dev. Spans can be recorded from any thread.
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def Span(self, name, category, **args):
+        # The yielded args can be added to while the span is open, for details only known at the end (like byte counts)
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            thread = threading.current_thread()
+            with self.lock:
+                self.thread_names[thread.ident] = thread.name
+                self.spans.append({
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": round((start - self.start) * 1e6),
+                    "dur": round((end - start) * 1e6),
+                    "pid": os.getpid(),
+                    "tid": thread.ident,
+                    "args": args
+                })
+
+    def WriteTrace(self, trace_path):
+        with self.lock:
+            events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}} for tid, name in self.thread_names.items()]
+            events.extend(self.spans)
+
+        with open(trace_path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def Reset(self):
+        with self.lock:
+            self.start = time.perf_counter()
+            self.spans = []
+
+    def Summary(self):
+        # Returns a table with the number of spans, and their total, average and longest duration for each category
+        categories = {}
+        with self.lock:
+            for span in self.spans:
+                categories.setdefault(span["cat"], []).append(span["dur"] / 1e6)
+
+        lines = ["{:<16} {:>6} {:>10} {:>10} {:>10}".format("stage", "count", "total (s)", "mean (s)", "max (s)")]
+        for category, durations in categories.items():
+            lines.append("{:<16} {:>6} {:>10.3f} {:>10.3f} {:>10.3f}".format(category, len(durations), sum(durations), sum(durations) / len(durations), max(durations)))
+        lines.append("{:<16} {:>6} {:>10.3f}".format("wall time", "", time.perf_counter() - self.start))
+        return "\n".join(lines)
+
+
+tracer = Tracer()
+
+
+def ReportTrace(trace_file):
+    logging.info("Time spent in each stage:\n" + tracer.Summary())
+    if trace_file is not None:
+        logging.info(f'Writing trace to {trace_file}')
+        tracer.WriteTrace(trace_file)
+
+
+@contextlib.contextmanager
+def AtomicWrite(path, mode='w'):
+    # Write to a temporary file next to path and only move it into place once it is complete, so an interrupted run or
+    # anything reading path never sees a partially written file
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def UpdateCSMMirror(clone_url, mirror_dir, branches, partial_clone):
+    # Keep a bare mirror of the CSM repo around between runs, and only fetch the targeted branches and tags. Only a
+    # handful of refs move each day, so this is a lot cheaper than cloning the entire history every time.
+    try:
+        csm_repo = Repo(mirror_dir)
+        csm_repo.git.remote("set-url", "origin", clone_url)
+        logging.info(f'Using existing CSM mirror at {mirror_dir}')
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError, git.exc.GitCommandError):
+        logging.info(f'Creating CSM mirror at {mirror_dir}')
+        if os.path.exists(mirror_dir):
+            shutil.rmtree(mirror_dir)
+        os.makedirs(mirror_dir)
+
+        csm_repo = Repo.init(mirror_dir, bare=True)
+        csm_repo.git.remote("add", "origin", clone_url)
+
+    # An empty refmap stops git from also creating remote tracking branches for the fetched refs, otherwise those would
+    # stick around after a branch was deleted.
+    fetch_args = ["--prune", "--tags", "--refmap="]
+    if partial_clone:
+        # Blobs are only downloaded when they are read, which for this script is just the manifests.
+        csm_repo.git.config("remote.origin.promisor", "true")
+        csm_repo.git.config("remote.origin.partialclonefilter", "blob:none")
+        fetch_args.append("--filter=blob:none")
+
+    # Fetching a ref that does not exist fails the entire fetch, so only ask for the branches that are present.
+    remote_branches = set()
+    for line in csm_repo.git.ls_remote("--heads", "origin").splitlines():
+        remote_branches.add(line.split("\t", 1)[1].removeprefix("refs/heads/"))
+
+    refspecs = []
+    for branch in branches:
+        if branch in remote_branches:
+            refspecs.append(f'+refs/heads/{branch}:refs/heads/{branch}')
+        elif branch in csm_repo.heads:
+            # Don't extract images from a branch that has since been deleted
+            logging.info(f'Branch "{branch}" no longer exists in the remote, removing it from the mirror')
+            csm_repo.git.update_ref("-d", f'refs/heads/{branch}')
+
+    logging.info(f'Fetching {len(refspecs)} branches into the CSM mirror')
+    csm_repo.git.fetch(*fetch_args, "origin", *refspecs)
+
+    return csm_repo
+
+
+def ResolveBranch(csm_repo, branch):
+    # Branches only exist as remote tracking branches in a fresh clone, so prefer those before falling back to
+    # anything else git can resolve (local branches, tags, commit SHAs).
+    for ref in [f'refs/remotes/origin/{branch}', f'refs/heads/{branch}', branch]:
+        try:
+            return csm_repo.git.rev_parse("--verify", "--quiet", f'{ref}^{{commit}}')
+        except git.exc.GitCommandError:
+            continue
+
+    return None
+
+
+class WorkingTreeReader:
+    # Reads CSM manifest files out of a checked out working tree
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def read_file(self, path):
+        with open(os.path.join(self.root_dir, path), 'rb') as f:
+            return f.read()
+
+    def list_files(self, directory, pattern="*.yaml"):
+        files = glob.glob(os.path.join(self.root_dir, directory, pattern))
+        return sorted(map(lambda e: os.path.relpath(e, self.root_dir), files))
+
+
+class GitObjectReader:
+    # Reads CSM manifest files for a single commit straight out of the git object store, so no working tree is needed.
+    # Blob contents are streamed through the long lived `git cat-file --batch` process owned by the Repo handle, which
+    # can only serve one request at a time. The lock is shared by all readers using the same Repo handle.
+    def __init__(self, csm_repo, commit_sha, lock):
+        self.csm_repo = csm_repo
+        self.commit_sha = commit_sha
+        self.lock = lock
+
+    def read_file(self, path):
+        with self.lock:
+            try:
+                _, object_type, _, data = self.csm_repo.git.get_object_data(f'{self.commit_sha}:{path}')
+            except ValueError:
+                # The cat-file process reports unknown objects as missing
+                raise FileNotFoundError(f'{path} does not exist at commit {self.commit_sha}')
+
+        if object_type != b"blob":
+            raise IsADirectoryError(f'{path} is not a file at commit {self.commit_sha}')
+        return data
+
+    def list_files(self, directory, pattern="*.yaml"):
+        # Each line looks like: 100644 blob 2f8f4a0e6a4c7f0b8a0b7e3d4e7b9a1f3d7a6e2c<TAB>manifests/core-services.yaml
+        files = []
+        for line in self.csm_repo.git.ls_tree(self.commit_sha, "--", directory.rstrip("/") + "/").splitlines():
+            object_info, path = line.split("\t", 1)
+            if object_info.split(" ")[1] == "blob" and fnmatch.fnmatch(os.path.basename(path), pattern):
+                files.append(path)
+
+        return sorted(files)
+
+
+def IndexDockerImages(node, prefix=None, index=None):
+    # Build an index of {image name: {registry/prefix: [tags]}} from the docker/index.yaml file. Images are listed under
+    # an "images" key that can be at any depth, with the keys above it making up the registry and prefix. For example:
+    # artifactory.algol60.net/csm-docker/stable:
+    #   images:
+    #     hms-trs-worker-http-v1:
+    #       - 1.7.0
+    if index is None:
+        index = {}
+
+    for key, value in node.items():
+        if key == "images" and prefix is not None and isinstance(value, dict):
+            for image_name, tags in value.items():
+                if tags is None:
+                    continue
+                if not isinstance(tags, list):
+                    tags = [tags]
+
+                index.setdefault(image_name, {}).setdefault(prefix, []).extend(map(str, tags))
+        elif isinstance(value, dict):
+            IndexDockerImages(value, key if prefix is None else f'{prefix}/{key}', index)
+
+    return index
+
+
+def FindDockerImages(config, manifest):
+    # Look up the images of interest directly in the index, instead of searching through the entire docker index. A
+    # lookup can optionally be limited to a single registry/prefix, otherwise the image is found in all of them.
+    docker_image_index = IndexDockerImages(manifest)
+
+    found_images = []
+    for mapping in config["github-repo-image-lookup"]:
+        image_name = mapping["image"]
+        for registry, tags in docker_image_index.get(image_name, {}).items():
+            if "registry" in mapping and mapping["registry"] != registry:
+                continue
+
+            for image_tag in tags:
+                image = {}
+                image["full-image"] = f'{registry}/{image_name}:{image_tag}'
+                image["short-name"] = image_name
+                image["image-tag"] = image_tag
+                if image not in found_images:
+                    found_images.append(image)
+
+    return found_images
+
+
+def FindHelmCharts(config, reader, branch):
+    # its possible the same helm chart is referenced multiple times, so we should collapse the list
+    # The download URL of each chart is resolved later from the index.yaml of the helm repo it comes from.
+    found_charts = []
+    for helm_file in reader.list_files(config["configuration"]["helm-manifest-directory"]):
+        logging.info("Processing manifest {} from CSM branch {}".format(helm_file, branch))
+        try:
+            manifest = yaml.safe_load(reader.read_file(helm_file))
+        except yaml.YAMLError as exc:
+            logging.error("Failed to parse manifest {}, error: {}".format(helm_file, exc))
+            # If there is malformed manifest in the CSM manifest, then this entire workflow will fail.
+            # TODO Instead we should make a best effort attempt at rebuilding images, but we should exist an non-zero exit code
+            # to signal that not all images were rebuilt.
+            continue
+        upstream_sources = {}
+        for chart in manifest["spec"]["sources"]["charts"]:
+            upstream_sources[chart["name"]] = chart["location"]
+        for chart in manifest["spec"]["charts"]:
+            chart_name = chart["name"]
+            chart_version = chart["version"]
+            if re.search(config["configuration"]["target-chart-regex"], chart["name"]) is not None:
+                # TODO We are also ignore unlikely situations where different CSM releases pull the same helm chart version from different locations.
+                found_charts.append({
+                    "name": chart_name,
+                    "version": chart_version,
+                    "helm-repo": upstream_sources[chart["source"]],
+                    "values": chart.get("values")
+                })
+
+    return found_charts
+
+
+def ExtractBranch(config, branch, reader):
+    # Pull everything this script needs out of a single CSM branch. This only reads from the provided reader, so it is
+    # safe to run for multiple branches at the same time.
+    logging.info("Extracting docker images and helm charts from CSM branch {}".format(branch))
+
+    # load the docker index file
+    try:
+        manifest = yaml.safe_load(reader.read_file(config["configuration"]["docker-image-manifest"]))
+    except yaml.YAMLError as exc:
+        logging.error(exc)
+        exit(1)
+
+    return {
+        "docker-images": FindDockerImages(config, manifest),
+        "helm-charts": FindHelmCharts(config, reader, branch)
+    }
+
+
+def ExtractBranchFromWorktree(config, csm_repo, worktree_dir, worktree_lock, branch):
+    commit_sha = ResolveBranch(csm_repo, branch)
+    if commit_sha is None:
+        logging.error(f'Failed to resolve branch "{branch}", skipping')
+        return None
+
+    # Only the manifest files are needed, so skip populating the rest of the working tree.
+    # Adding and removing worktrees reads the administrative files of all other worktrees, so git will fail if that
+    # happens at the same time for two worktrees. These are quick, the file checkouts still happen in parallel.
+    worktree_path = os.path.join(worktree_dir, branch.replace("/", "-"))
+    with worktree_lock:
+        csm_repo.git.worktree("add", "--detach", "--no-checkout", worktree_path, commit_sha)
+    try:
+        worktree = git.Git(worktree_path)
+        worktree.checkout(commit_sha, "--",
+            config["configuration"]["docker-image-manifest"],
+            config["configuration"]["helm-manifest-directory"]
+        )
+
+        result = ExtractBranch(config, branch, WorkingTreeReader(worktree_path))
+    finally:
+        with worktree_lock:
+            csm_repo.git.worktree("remove", "--force", worktree_path)
+
+    result["git-sha"] = commit_sha
+    result["git-tags"] = list(filter(lambda e: e != "", csm_repo.git.tag("--points-at", commit_sha).split("\n")))
+    return result
+
+
+def ExtractBranchFromGitObjects(config, csm_repo, lock, branch):
+    commit_sha = ResolveBranch(csm_repo, branch)
+    if commit_sha is None:
+        logging.error(f'Failed to resolve branch "{branch}", skipping')
+        return None
+
+    result = ExtractBranch(config, branch, GitObjectReader(csm_repo, commit_sha, lock))
+    result["git-sha"] = commit_sha
+    result["git-tags"] = list(filter(lambda e: e != "", csm_repo.git.tag("--points-at", commit_sha).split("\n")))
+    return result
+
+
+def ExtractBranchFromCheckout(config, csm_repo, csm_dir, branch):
+    logging.info("Checking out CSM branch {}".format(branch))
+    try:
+        csm_repo.git.checkout(branch)
+    except git.exc.GitCommandError as e:
+        logging.error(f'Failed to checkout branch "{branch}", skipping')
+        return None
+
+    result = ExtractBranch(config, branch, WorkingTreeReader(csm_dir))
+    result["git-sha"] = csm_repo.head.object.hexsha
+    result["git-tags"] = list(filter(lambda e: e != "", csm_repo.git.tag("--points-at", "HEAD").split("\n")))
+    return result
+
+
+def TraceBranchRead(extract, *args):
+    # The branch is always the last argument of the ExtractBranchFrom* functions
+    branch = args[-1]
+    with tracer.Span(f'read {branch}', "git read", branch=branch) as span:
+        result = extract(*args)
+        if result is not None:
+            span["git-sha"] = result["git-sha"]
+    return result
+
+
+def ExtractBranches(config, csm_repo, csm_dir, extraction_mode, workers, branches):
+    # Yields (branch, result) as each branch finishes, so later stages can start on a branch while the others are
+    # still being read.
+
+    if extraction_mode == "checkout":
+        # All branches share a single working tree, so they have to be processed one at a time.
+        for branch in branches:
+            yield branch, TraceBranchRead(ExtractBranchFromCheckout, config, csm_repo, csm_dir, branch)
+        return
+
+    if extraction_mode == "git-objects":
+        # Nothing is written to disk, the manifests are read directly out of the object store.
+        lock = threading.Lock()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="git-read") as executor:
+            futures = {executor.submit(TraceBranchRead, ExtractBranchFromGitObjects, config, csm_repo, lock, branch): branch for branch in branches}
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+        return
+
+    # Each branch gets its own worktree, so all of the branches can be processed at the same time.
+    worktree_dir = os.path.abspath(csm_dir.rstrip("/") + "-worktrees")
+    if os.path.exists(worktree_dir):
+        shutil.rmtree(worktree_dir)
+    csm_repo.git.worktree("prune")
+    os.mkdir(worktree_dir)
+
+    worktree_lock = threading.Lock()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="git-read") as executor:
+            futures = {executor.submit(TraceBranchRead, ExtractBranchFromWorktree, config, csm_repo, worktree_dir, worktree_lock, branch): branch for branch in branches}
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+    finally:
+        shutil.rmtree(worktree_dir)
+        csm_repo.git.worktree("prune")
+
+
+def ReadChartMetadata(chart_path):
+    # Stream through the chart tarball and only pull out the top level Chart.yaml and values.yaml, instead of extracting
+    # the whole chart to disk. The structure is well known: {helm-chart}/Chart.yaml and {helm-chart}/values.yaml
+    wanted_files = ["Chart.yaml", "values.yaml"]
+    found_files = {}
+    with tarfile.open(chart_path, "r|gz") as chart_tarball:
+        for member in chart_tarball:
+            path_parts = member.name.split("/")
+            if not member.isfile() or len(path_parts) != 2 or path_parts[1] not in wanted_files:
+                continue
+
+            try:
+                found_files[path_parts[1]] = yaml.safe_load(chart_tarball.extractfile(member))
+            except yaml.YAMLError as exc:
+                logging.error(exc)
+                exit(1)
+
+            if len(found_files) == len(wanted_files):
+                break
+
+    for file_name in wanted_files:
+        if file_name not in found_files:
+            logging.error(f'Chart {chart_path} is missing {file_name}')
+            exit(1)
+
+    return found_files["Chart.yaml"], found_files["values.yaml"]
+
+
+class ImageRegistry:
+    # Keeps track of the images found for each Github repo, along with the CSM releases that use them. Images are keyed
+    # by their full image reference, and the CSM releases of each image are also tracked as a set, so adding an image
+    # or a release to an existing image does not require searching through everything found so far. The tags of each
+    # image repo are also kept per CSM release, in the order that release found them, as the first tag is the one that
+    # gets deployed and tested. It must not depend on what the other CSM releases found.
+    def __init__(self):
+        self.github_repos = {}
+        self.image_releases = {}
+        self.release_tags = {}
+
+    def Add(self, github_repo, full_image, short_name, image_tag, csm_release):
+        images = self.github_repos.setdefault(github_repo, {})
+
+        if full_image not in images:
+            # This is a new image
+            images[full_image] = {
+                "full-image": full_image,
+                "short-name": short_name,
+                "image-tag": image_tag,
+                "csm-releases": []
+            }
+            self.image_releases[(github_repo, full_image)] = set()
+
+        # Add the accompanying CSM release branch to an image, it may have already been found in a different CSM release
+        if csm_release not in self.image_releases[(github_repo, full_image)]:
+            self.image_releases[(github_repo, full_image)].add(csm_release)
+            images[full_image]["csm-releases"].append(csm_release)
+
+        image_repo = full_image.rsplit(":", 1)[0]
+        tags = self.release_tags.setdefault(csm_release, {}).setdefault(image_repo, [])
+        if image_tag not in tags:
+            tags.append(image_tag)
+
+    def ImagesByCSMRelease(self):
+        images_by_csm_release = {}
+        for csm_release, tags_by_image_repo in self.release_tags.items():
+            images_by_csm_release[csm_release] = {
+                "images": {image_repo: list(tags) for image_repo, tags in tags_by_image_repo.items()}
+            }
+
+        return images_by_csm_release
+
+
+def FileDigest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ParseImageReference(image):
+    # Split an image reference like registry:5000/repo/name:tag@sha256:abc into (repo, tag, digest). The tag and digest
+    # are None when not present.
+    digest = None
+    if "@" in image:
+        image, digest = image.split("@", 1)
+
+    tag = None
+    if ":" in image.split("/")[-1]:
+        image, tag = image.rsplit(":", 1)
+
+    return image, tag, digest
+
+
+def FindContainerImages(node):
+    # Walk a Kubernetes object looking for the images used by containers. This covers pods nested in any workload, such
+    # as Deployments, DaemonSets, Jobs and the jobTemplate of CronJobs.
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key in ["containers", "initContainers"] and isinstance(value, list):
+                for container in value:
+                    if isinstance(container, dict) and isinstance(container.get("image"), str):
+                        yield container["image"]
+            else:
+                yield from FindContainerImages(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from FindContainerImages(item)
+
+
+def TemplateChartImages(chart_path, values_override_path):
+    # Parse the rendered chart as a multi-document YAML stream straight from the helm process, instead of buffering
+    # the whole output. stderr goes to a temporary file so a chatty helm can't block on a full pipe.
+    with tempfile.TemporaryFile(mode="w+") as stderr, tracer.Span(f'helm template {os.path.basename(chart_path)}', "helm template", chart=chart_path, values=values_override_path) as span:
+        # TODO thought about inlining this script, but using shell=True can be dangerous.
+        process = subprocess.Popen(["helm", "template", chart_path, "-f", values_override_path], stdout=subprocess.PIPE, stderr=stderr, text=True)
+
+        extracted_images = []
+        try:
+            for document in yaml.load_all(process.stdout, Loader=YAMLLoader):
+                for image in FindContainerImages(document):
+                    extracted_images.append(ParseImageReference(image))
+        except yaml.YAMLError as exc:
+            process.kill()
+            logging.error("Failed to parse templated helm chart {}: {}".format(chart_path, exc))
+            exit(1)
+        finally:
+            process.stdout.close()
+            process.wait()
+
+        if process.returncode != 0:
+            stderr.seek(0)
+            logging.error("Failed to template helm chart. Exit code {}".format(process.returncode))
+            logging.error("stderr: {}".format(stderr.read()))
+            exit(1)
+
+        span["images"] = len(extracted_images)
+
+    return extracted_images
+
+
+class HelmRepoIndex:
+    # Resolves chart download URLs and digests from the index.yaml of each upstream helm repo. Each index is fetched
+    # at most once per run. When a cache directory is given the index is kept on disk, and only downloaded again when
+    # it has changed (conditional GET using the ETag and Last-Modified headers).
+    def __init__(self, chart_downloader, index_cache_dir=None):
+        self.chart_downloader = chart_downloader
+        self.index_cache_dir = index_cache_dir
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def FetchIndex(self, index_url):
+        with tracer.Span(f'fetch {index_url}', "helm repo index", url=index_url) as span:
+            index_data = self.FetchIndexData(index_url)
+            span["bytes"] = len(index_data)
+        return index_data
+
+    def FetchIndexData(self, index_url):
+        cache_path = None
+        cache_headers = {}
+        request_headers = {}
+        if self.index_cache_dir is not None:
+            os.makedirs(self.index_cache_dir, exist_ok=True)
+            cache_path = os.path.join(self.index_cache_dir, hashlib.sha256(index_url.encode()).hexdigest() + ".yaml")
+            if os.path.exists(cache_path) and os.path.exists(cache_path + ".headers"):
+                with open(cache_path + ".headers") as f:
+                    cache_headers = json.load(f)
+                if "ETag" in cache_headers:
+                    request_headers["If-None-Match"] = cache_headers["ETag"]
+                if "Last-Modified" in cache_headers:
+                    request_headers["If-Modified-Since"] = cache_headers["Last-Modified"]
+
+        session = self.chart_downloader.GetSession(urllib.parse.urlparse(index_url).hostname)
+        r = session.get(index_url, headers=request_headers)
+        if r.status_code == 304:
+            logging.info(f'Helm repo index {index_url} has not changed, using cached copy')
+            with open(cache_path, 'rb') as f:
+                return f.read()
+        if r.status_code != 200:
+            logging.error(f'Unexpected status code {r.status_code} when downloading helm repo index {index_url}')
+            exit(1)
+
+        logging.info(f'Downloaded helm repo index {index_url}')
+        if cache_path is not None:
+            with AtomicWrite(cache_path, 'wb') as f:
+                f.write(r.content)
+            with AtomicWrite(cache_path + ".headers") as f:
+                json.dump({header: r.headers[header] for header in ["ETag", "Last-Modified"] if header in r.headers}, f)
+
+        return r.content
+
+    def GetIndex(self, helm_repo):
+        # Only the lookup of the index is done under the lock. The first thread to ask for a helm repo fetches and
+        # parses its index, while any other thread asking for the same repo waits for it, and threads asking for other
+        # repos are not held up.
+        with self.lock:
+            index_future = self.indexes.get(helm_repo)
+            fetch = index_future is None
+            if fetch:
+                index_future = concurrent.futures.Future()
+                self.indexes[helm_repo] = index_future
+
+        if fetch:
+            try:
+                index_future.set_result(self.LoadIndex(helm_repo))
+            except BaseException as exc:
+                # Let whoever asks next try again, rather than failing on this forever
+                with self.lock:
+                    if self.indexes.get(helm_repo) is index_future:
+                        del self.indexes[helm_repo]
+                index_future.set_exception(exc)
+                raise
+
+        return index_future.result()
+
+    def LoadIndex(self, helm_repo):
+        index_url = urljoin(helm_repo.rstrip("/") + "/", "index.yaml")
+        try:
+            index = yaml.load(self.FetchIndex(index_url), Loader=YAMLLoader)
+        except yaml.YAMLError as exc:
+            logging.error(f'Failed to parse helm repo index {index_url}: {exc}')
+            exit(1)
+
+        # Build up a lookup of {chart name: {chart version: {download-url, digest}}}. Chart URLs in the index can
+        # be relative to the location of the index.
+        charts = {}
+        for chart_name, entries in (index.get("entries") or {}).items():
+            for entry in entries:
+                if not entry.get("urls"):
+                    continue
+                charts.setdefault(chart_name, {})[str(entry["version"])] = {
+                    "download-url": urljoin(index_url, entry["urls"][0]),
+                    "digest": entry.get("digest")
+                }
+
+        return charts
+
+    def Resolve(self, helm_repo, chart_name, chart_version):
+        return self.GetIndex(helm_repo).get(chart_name, {}).get(str(chart_version))
+
+    def Clear(self):
+        # Fetch each index again the next time it is used
+        with self.lock:
+            self.indexes = {}
+
+
+class ChartDownloader:
+    # Downloads helm charts with a pooled HTTP session per host, running a bounded number of downloads at the same time.
+    # Charts are kept in a cache directory keyed by chart name and version (and digest when known), so a chart version
+    # that has already been downloaded is never downloaded again.
+    def __init__(self, chart_cache_dir, helm_repo_creds, workers):
+        self.chart_cache_dir = chart_cache_dir
+        self.helm_repo_creds = helm_repo_creds
+        self.workers = workers
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+    def GetSession(self, hostname):
+        with self.sessions_lock:
+            if hostname not in self.sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+
+                # Check to see if authentication is required for this helm repo
+                if hostname in self.helm_repo_creds:
+                    session.auth = requests.auth.HTTPBasicAuth(self.helm_repo_creds[hostname]["username"], self.helm_repo_creds[hostname]["password"])
+
+                self.sessions[hostname] = session
+
+            return self.sessions[hostname]
+
+    def ChartPath(self, chart_name, chart_version, digest=None):
+        file_name = f'{chart_name}-{chart_version}.tgz'
+        if digest is not None:
+            return os.path.join(self.chart_cache_dir, chart_name, str(chart_version), digest, file_name)
+        return os.path.join(self.chart_cache_dir, chart_name, str(chart_version), file_name)
+
+    def Download(self, chart_name, chart_version, download_url, digest=None):
+        with tracer.Span(f'download {chart_name}-{chart_version}', "chart download", url=download_url) as span:
+            chart_path = self.DownloadChart(chart_name, chart_version, download_url, digest, span)
+        return chart_path
+
+    def DownloadChart(self, chart_name, chart_version, download_url, digest, span):
+        chart_path = self.ChartPath(chart_name, chart_version, digest)
+        if os.path.exists(chart_path):
+            logging.info(f'Using cached chart {chart_path}')
+            span["cached"] = True
+            return chart_path
+
+        logging.info(f'Downloading chart {download_url}')
+        r = self.GetSession(urllib.parse.urlparse(download_url).hostname).get(download_url, stream=True)
+        if r.status_code != 200:
+            logging.error(f'Unexpected status code {r.status_code} when downloading chart {download_url}')
+            exit(1)
+
+        # A partially downloaded chart, or one that doesn't match its digest, never ends up in the cache
+        os.makedirs(os.path.dirname(chart_path), exist_ok=True)
+        chart_digest = hashlib.sha256()
+        chart_bytes = 0
+        with AtomicWrite(chart_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                if chunk:
+                    f.write(chunk)
+                    chart_digest.update(chunk)
+                    chart_bytes += len(chunk)
+
+            if digest is not None and chart_digest.hexdigest() != digest:
+                logging.error(f'Digest mismatch for chart {download_url}. Expected {digest}, got {chart_digest.hexdigest()}')
+                exit(1)
+
+        span["cached"] = False
+        span["bytes"] = chart_bytes
+        return chart_path
+
+
+@functools.cache
+def ExtractorSourceHash():
+    # Changes to how images are extracted invalidate every cached result
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def BranchCacheKey(config_hash, branch_result):
+    # The images found for a branch only depend on the commit the branch points to, this script's configuration and
+    # source, and the helm charts (their digests and value overrides) referenced by the branch's manifests.
+    key_data = {
+        "git-sha": branch_result["git-sha"],
+        "configuration": config_hash,
+        "extractor": ExtractorSourceHash(),
+        "helm-charts": branch_result["helm-charts"]
+    }
+    # The value overrides come from YAML, so they can contain dates and mixed key types that JSON can't serialize
+    return hashlib.sha256(yaml.dump(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def LoadResultCache(result_cache_path):
+    if not os.path.exists(result_cache_path):
+        return {}
+
+    try:
+        with open(result_cache_path) as f:
+            return json.load(f)
+    except json.JSONDecodeError as exc:
+        logging.warning(f'Ignoring corrupted result cache {result_cache_path}: {exc}')
+        return {}
+
+
+def SaveResultCache(result_cache_path, result_cache):
+    with AtomicWrite(result_cache_path) as f:
+        json.dump(result_cache, f, indent=2)
+
+
+def FindImageReposOfInterest(chart, values):
+    ## Assumed values.yaml structure
+    # global:
+    #  appVersion: 2.1.0
+    #  testVersion: 2.1.0
+    # tests:
+    #  image:
+    #    repository: artifactory.algol60.net/csm-docker/stable/cray-capmc-test
+    #    pullPolicy: IfNotPresent
+    #
+    # image:
+    #  repository: artifactory.algol60.net/csm-docker/stable/cray-capmc
+    #  pullPolicy: IfNotPresent
+    ### Its possible that there might not be a 'tests' value, but I will handle that.
+
+    # Determine the names of the main application image, and the test image
+    images_repos_of_interest = []
+    if chart["name"] == "cray-power-control":
+        images_repos_of_interest.append(values["cray-service"]["containers"]["cray-power-control"]["image"]["repository"])
+    else:
+        images_repos_of_interest.append(values["image"]["repository"])
+    if "testVersion" in values["global"]:
+        images_repos_of_interest.append(values["tests"]["image"]["repository"])
+
+    return images_repos_of_interest
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class ExtractionPipeline:
+    # Runs the extraction as a set of stages joined by bounded queues, so a chart can be downloading while other CSM
+    # branches are still being read, and can be templated as soon as it lands:
+    #
+    #   git read -> chart fetch -> helm template -> aggregate
+    #
+    # Charts are only downloaded once per (name, version), and templated once per unique (chart digest, overrides),
+    # no matter how many branches reference them. If any stage fails the whole pipeline is torn down, and the failure
+    # is raised again from Run().
+    def __init__(self, config, config_hash, chart_downloader, helm_repo_index, helm_dir, extraction_mode, branch_workers, render_workers, queue_size):
+        self.config = config
+        self.config_hash = config_hash
+        self.chart_downloader = chart_downloader
+        self.helm_repo_index = helm_repo_index
+        self.helm_dir = helm_dir
+        self.extraction_mode = extraction_mode
+        self.branch_workers = branch_workers
+        self.render_workers = render_workers
+        self.queue_size = queue_size
+
+        self.failure_lock = threading.Lock()
+
+    def Put(self, work_queue, item):
+        # Blocks while the queue is full, but gives up if another stage has failed
+        while True:
+            if self.failed.is_set():
+                raise PipelineAborted()
+            try:
+                work_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def Get(self, work_queue):
+        # Blocks while the queue is empty, but gives up if another stage has failed
+        while True:
+            if self.failed.is_set():
+                raise PipelineAborted()
+            try:
+                return work_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def RunStage(self, stage, *args):
+        try:
+            stage(*args)
+        except PipelineAborted:
+            pass
+        except BaseException as exc:
+            # Errors are logged where they happen before calling exit(1), anything else is unexpected
+            if not isinstance(exc, SystemExit):
+                logging.exception(f'Extraction stage {stage.__name__} failed')
+            with self.failure_lock:
+                if self.failure is None:
+                    self.failure = exc
+            self.failed.set()
+
+    def ReadBranches(self, csm_repo, csm_dir, branches):
+        for branch, branch_result in ExtractBranches(self.config, csm_repo, csm_dir, self.extraction_mode, self.branch_workers, branches):
+            if branch_result is not None:
+                self.Put(self.branch_queue, (branch, branch_result))
+        self.Put(self.branch_queue, None)
+
+    def FetchChart(self, chart):
+        chart_path = self.chart_downloader.Download(chart["name"], chart["version"], chart["download-url"], chart.get("digest"))
+
+        logging.info("Processing chart: {}".format(chart_path))
+        with tracer.Span(f'read {os.path.basename(chart_path)}', "chart metadata", chart=chart_path):
+            chart_metadata, values = ReadChartMetadata(chart_path)
+
+        # THIS ASSUMES there is only one source and its the 0th one that we care about. I believe this is true for HMS
+        github_repo = chart_metadata["sources"][0].split('/')[-1]
+        images_repos_of_interest = FindImageReposOfInterest(chart_metadata, values)
+
+        logging.info("\tGithub repo: {}".format(github_repo))
+        logging.info("\tImage repos of interest:")
+        for image_repo in images_repos_of_interest:
+            logging.info("\t- {}".format(image_repo))
+
+        return {
+            "chart-path": chart_path,
+            "chart-digest": FileDigest(chart_path),
+            "github-repo": github_repo,
+            "images-repos-of-interest": images_repos_of_interest
+        }
+
+    def ChartFetched(self, branch, chart, future):
+        # Runs on the download worker once the chart is on disk (or failed to download)
+        try:
+            self.Put(self.render_queue, (branch, chart, future))
+        except PipelineAborted:
+            pass
+
+    def FetchCharts(self, result_cache):
+        downloads = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.chart_downloader.workers, thread_name_prefix="chart-fetch") as executor:
+            while (item := self.Get(self.branch_queue)) is not None:
+                branch, branch_result = item
+
+                # Resolve where to download each helm chart from
+                for chart in branch_result["helm-charts"]:
+                    resolved_chart = self.helm_repo_index.Resolve(chart["helm-repo"], chart["name"], chart["version"])
+                    if resolved_chart is None:
+                        logging.error(f'Unable to find chart {chart["name"]} version {chart["version"]} in helm repo {chart["helm-repo"]}, referenced by CSM branch {branch}')
+                        exit(1)
+
+                    chart["download-url"] = resolved_chart["download-url"]
+                    chart["digest"] = resolved_chart["digest"]
+
+                # Reuse results from previous runs for branches that have not changed
+                branch_result["cache-key"] = BranchCacheKey(self.config_hash, branch_result)
+                branch_result["cached-images"] = None
+                if branch in result_cache and result_cache[branch]["cache-key"] == branch_result["cache-key"]:
+                    logging.info(f'CSM branch {branch} is unchanged since the last run at {branch_result["git-sha"]}, reusing previous results')
+                    branch_result["cached-images"] = result_cache[branch]["images"]
+
+                self.Put(self.result_queue, ("branch", branch, branch_result))
+                if branch_result["cached-images"] is not None:
+                    continue
+
+                # ASSUMPTION: It is being assumed that a HMS helm chart will be referenced only once in all loftsman manifests for any
+                # CSM release. The following logic will need to change, if we every decide to deploy the same helm chart multiple times
+                # with different release names.
+                for chart in branch_result["helm-charts"]:
+                    download_key = (chart["name"], chart["version"])
+                    if download_key not in downloads:
+                        downloads[download_key] = executor.submit(self.FetchChart, chart)
+                    downloads[download_key].add_done_callback(functools.partial(self.ChartFetched, branch, chart))
+
+        # Leaving the executor waits for every download, and the callbacks that pass them on
+        self.Put(self.render_queue, None)
+
+    def ChartRendered(self, branch, chart, fetched_chart, future):
+        # Runs on the render worker once helm template has finished (or failed)
+        try:
+            self.Put(self.result_queue, ("chart-images", branch, chart, fetched_chart, future))
+        except PipelineAborted:
+            pass
+
+    def RenderCharts(self):
+        # Many CSM branches use byte for byte identical value overrides for the same chart version, so only template
+        # each unique combination of chart and value overrides once.
+        renders = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.render_workers, thread_name_prefix="helm-template") as executor:
+            while (item := self.Get(self.render_queue)) is not None:
+                branch, chart, download_future = item
+                fetched_chart = download_future.result()
+
+                overrides_digest = hashlib.sha256(yaml.dump(chart["values"], sort_keys=True).encode()).hexdigest()
+                render_key = (fetched_chart["chart-digest"], overrides_digest)
+                if render_key not in renders:
+                    values_override_path = os.path.join(self.helm_dir, "values-{}-{}-{}.yaml".format(chart["name"], chart["version"], overrides_digest[:12]))
+                    logging.info("\tWriting out value overrides {}".format(values_override_path))
+                    with open(values_override_path, "w") as f:
+                        yaml.dump(chart["values"], f)
+
+                    renders[render_key] = executor.submit(TemplateChartImages, fetched_chart["chart-path"], values_override_path)
+                renders[render_key].add_done_callback(functools.partial(self.ChartRendered, branch, chart, fetched_chart))
+
+        logging.info(f'templated {len(renders)} unique helm chart renders')
+        self.Put(self.result_queue, None)
+
+    def Aggregate(self):
+        while (item := self.Get(self.result_queue)) is not None:
+            if item[0] == "branch":
+                _, branch, branch_result = item
+                self.branch_results[branch] = branch_result
+            else:
+                _, branch, chart, fetched_chart, render_future = item
+                self.chart_images[(branch, chart["name"], chart["version"])] = (fetched_chart, render_future.result())
+
+    def Run(self, csm_repo, csm_dir, result_cache, branches):
+        # Returns the result of each CSM branch that could be read, along with the images found in each helm chart
+        # keyed by (branch, chart name, chart version)
+        self.failed = threading.Event()
+        self.failure = None
+        self.branch_queue = queue.Queue(maxsize=self.queue_size)
+        self.render_queue = queue.Queue(maxsize=self.queue_size)
+        self.result_queue = queue.Queue(maxsize=self.queue_size)
+        self.branch_results = {}
+        self.chart_images = {}
+
+        stages = [
+            threading.Thread(target=self.RunStage, args=(self.ReadBranches, csm_repo, csm_dir, branches), name="git-read-stage"),
+            threading.Thread(target=self.RunStage, args=(self.FetchCharts, result_cache), name="chart-fetch-stage"),
+            threading.Thread(target=self.RunStage, args=(self.RenderCharts,), name="helm-template-stage"),
+        ]
+        for stage in stages:
+            stage.start()
+
+        # Results are aggregated on the calling thread
+        self.RunStage(self.Aggregate)
+        for stage in stages:
+            stage.join()
+
+        if self.failure is not None:
+            raise self.failure
+
+        return self.branch_results, self.chart_images
+
+
+def BuildImagesByCSMRelease(config, branch_results, chart_images):
+    # Everything is registered in the order of the targeted CSM branches, regardless of the order the pipeline stages
+    # finished in, so the output is the same from run to run.
+    branches = [branch for branch in config["configuration"]["targeted-csm-branches"] if branch in branch_results]
+
+    ####################
+    # Go Get LIST of Docker Images we need to investigate!
+    ####################
+    logging.info("find docker images")
+    images_to_rebuild = ImageRegistry()
+
+    short_name_to_github_repo = {}
+    for mapping in config["github-repo-image-lookup"]:
+        short_name_to_github_repo[mapping["image"]] = mapping["github-repo"]
+
+    for branch in branches:
+        if branch_results[branch]["cached-images"] is not None:
+            continue
+
+        logging.info("\tCross reference docker images with lookup for CSM branch {}".format(branch))
+        for found_image in branch_results[branch]["docker-images"]:
+            if found_image["short-name"] in short_name_to_github_repo:
+                logging.info("\tFound image {}".format(found_image))
+
+                github_repo = short_name_to_github_repo[found_image["short-name"]]
+                images_to_rebuild.Add(github_repo, found_image["full-image"], found_image["short-name"], found_image["image-tag"], branch)
+
+    ####################
+    # Process helm charts
+    ####################
+    logging.info("find helm charts")
+
+    # The following is really ugly, but prints out a nice summary of the chart overrides across all of the CSM branches this script it is looking at.
+    logging.info("Manifest value overrides")
+    manifest_values_overrides = {}
+    for branch in config["configuration"]["targeted-csm-branches"]:
+        manifest_values_overrides[branch] = {}
+        if branch not in branch_results or branch_results[branch]["cached-images"] is not None:
+            continue
+
+        for chart in branch_results[branch]["helm-charts"]:
+            if chart["values"] is not None:
+                manifest_values_overrides[branch][chart["name"]] = chart["values"]
+    logging.info("\n"+yaml.dump(manifest_values_overrides))
+
+    # Each CSM branch registers the images of its charts in the order of its own manifests, so the order of the tags
+    # found for a branch does not depend on the other branches
+    for branch in branches:
+        if branch_results[branch]["cached-images"] is not None:
+            continue
+
+        logging.info("CSM Branch {}".format(branch))
+        for chart_name, chart_version in dict.fromkeys((chart["name"], chart["version"]) for chart in branch_results[branch]["helm-charts"]):
+            fetched_chart, rendered_images = chart_images[(branch, chart_name, chart_version)]
+            logging.info("\tChart {} {}".format(chart_name, chart_version))
+
+            logging.info("\t\tImages in use:")
+            for image_repo, image_tag, image_digest in rendered_images:
+                if image_repo not in fetched_chart["images-repos-of-interest"] or image_tag is None:
+                    continue
+
+                image = f'{image_repo}:{image_tag}'
+                logging.info("\t\t- {}".format(image))
+
+                images_to_rebuild.Add(fetched_chart["github-repo"], image, image_repo.split('/')[-1], image_tag, branch)
+
+    images_by_csm_release = images_to_rebuild.ImagesByCSMRelease()
+
+    for branch in branches:
+        cached_images = branch_results[branch]["cached-images"]
+        if cached_images is not None and len(cached_images) != 0:
+            images_by_csm_release[branch] = {
+                "images": cached_images
+            }
+
+    # Keep the releases in the same order as the targeted CSM branches
+    images_by_csm_release = {release_name: images_by_csm_release[release_name] for release_name in branches if release_name in images_by_csm_release}
+
+    # Add in git information
+    for release_name in images_by_csm_release:
+        images_by_csm_release[release_name]["git_sha"] = branch_results[release_name]["git-sha"]
+        images_by_csm_release[release_name]["git_tags"] = branch_results[release_name]["git-tags"]
+
+    return images_by_csm_release
+
+
+def WriteOutput(output_path, output_db, images_by_csm_release):
+    with AtomicWrite(output_path) as f:
+        json.dump(images_by_csm_release, f, indent=2)
+
+    if output_db is not None:
+        logging.info(f'Writing CSM releases to {output_db}')
+        csm_image_store.write_releases(output_db, images_by_csm_release, source="csm_manifest_extractor", prune=True)
+
+
+def UpdateResultCache(result_cache, branch_results, images_by_csm_release):
+    for branch, branch_result in branch_results.items():
+        result_cache[branch] = {
+            "cache-key": branch_result["cache-key"],
+            "images": images_by_csm_release.get(branch, {"images": {}})["images"]
+        }
+
+
+def ReportChange(previous_output, current_output, events_file, on_change_command, output_path):
+    changed_releases = sorted(release for release in previous_output.keys() | current_output.keys() if previous_output.get(release) != current_output.get(release))
+    logging.info(f'Images changed for CSM releases: {", ".join(changed_releases)}')
+
+    if events_file is not None:
+        event = {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "changed-csm-releases": changed_releases,
+            "git-shas": {release: images["git_sha"] for release, images in current_output.items()}
+        }
+        with open(events_file, 'a') as f:
+            f.write(json.dumps(event) + "\n")
+
+    if on_change_command is not None:
+        env = dict(os.environ)
+        env["CHANGED_CSM_RELEASES"] = " ".join(changed_releases)
+        result = subprocess.run(shlex.split(on_change_command) + [output_path], env=env)
+        if result.returncode != 0:
+            logging.warning(f'On change command exited with {result.returncode}')
+
+
+def WatchCSMBranches(config, pipeline, csm_repo, csm_dir, clone_url, partial_clone, interval, result_cache, result_cache_path, output_path, output_db, events_file, on_change_command):
+    # Keep the CSM mirror, downloaded charts and the results of each branch around, and only extract the branches
+    # whose head has moved since the last time around. The output is only rewritten when it actually changes.
+    branches = config["configuration"]["targeted-csm-branches"]
+    branch_shas = {}
+    branch_results = {}
+    chart_images = {}
+    images_by_csm_release = None
+
+    # The mirror was just fetched before the first pass. Every later pass fetches again, even if the previous one
+    # failed, as the fix for the failure may be a new commit on a branch.
+    first_pass = True
+    while True:
+        try:
+            if not first_pass:
+                with tracer.Span("fetch CSM mirror", "git clone", url=clone_url):
+                    csm_repo = UpdateCSMMirror(clone_url, csm_dir, branches, partial_clone)
+
+            current_shas = {branch: ResolveBranch(csm_repo, branch) for branch in branches}
+            changed_branches = [branch for branch in branches if current_shas[branch] != branch_shas.get(branch)]
+            if len(changed_branches) != 0:
+                logging.info(f'CSM branches changed: {", ".join(changed_branches)}')
+
+                # The helm repos may have new chart versions for the branches that moved
+                pipeline.helm_repo_index.Clear()
+                changed_results, changed_chart_images = pipeline.Run(csm_repo, csm_dir, result_cache, changed_branches)
+
+                for branch in changed_branches:
+                    branch_results.pop(branch, None)
+                chart_images = {key: images for key, images in chart_images.items() if key[0] not in changed_branches}
+                branch_results.update(changed_results)
+                chart_images.update(changed_chart_images)
+                branch_shas = current_shas
+
+            # Tags can be added to a commit without the branch moving
+            for branch, branch_result in branch_results.items():
+                branch_result["git-tags"] = list(filter(lambda e: e != "", csm_repo.git.tag("--points-at", branch_result["git-sha"]).split("\n")))
+
+            with tracer.Span("aggregate results", "aggregate"):
+                current_output = BuildImagesByCSMRelease(config, branch_results, chart_images)
+
+            if current_output != images_by_csm_release:
+                WriteOutput(output_path, output_db, current_output)
+                if images_by_csm_release is not None:
+                    ReportChange(images_by_csm_release, current_output, events_file, on_change_command, output_path)
+                images_by_csm_release = current_output
+
+                if result_cache_path is not None:
+                    UpdateResultCache(result_cache, branch_results, images_by_csm_release)
+                    SaveResultCache(result_cache_path, result_cache)
+            else:
+                logging.info("No changes to the images of any CSM release")
+        except (Exception, SystemExit) as exc:
+            # Most likely a network problem talking to Github or artifactory, try again next time around. The last good
+            # output is left in place.
+            if not isinstance(exc, SystemExit):
+                logging.exception("Failed to extract CSM branches")
+            logging.error(f'Extraction failed, retrying in {interval} seconds')
+
+        first_pass = False
+
+        # Only keep the spans of a single pass around, this runs for a long time
+        logging.info("Time spent in each stage:\n" + tracer.Summary())
+        tracer.Reset()
+
+        logging.info(f'Checking for changes in {interval} seconds')
+        time.sleep(interval)
 
-def FindImagePart(value):
-    # example: root['artifactory.algol60.net/csm-docker/stable']['images']['hms-trs-worker-http-v1'][0]
-    replace0 = "root['artifactory.algol60.net/csm-docker/stable']['images']['"
-    replace1 = "'][0]"
-    value = value.replace(replace0, '')
-    return value.replace(replace1, '')
 
 if __name__ == '__main__':
 
+    ####################
+    # Parse CLI flags
+    ####################
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--extraction-mode", type=str, default="git-objects", choices=["checkout", "worktree", "git-objects"], help="How CSM branches are read. 'checkout' processes branches one at a time in a single working tree, 'worktree' processes branches in parallel using a git worktree per branch, 'git-objects' reads the manifests directly from a bare clone without any working tree")
+    parser.add_argument("--branch-workers", type=int, default=4, help="Max number of CSM branches to extract at the same time")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Directory to keep a bare mirror of the CSM repo, downloaded helm charts and extraction results in between runs. When not set everything is downloaded from scratch")
+    parser.add_argument("--download-workers", type=int, default=4, help="Max number of helm charts to download at the same time")
+    parser.add_argument("--render-workers", type=int, default=os.cpu_count(), help="Max number of helm charts to template at the same time")
+    parser.add_argument("--output-db", type=str, default=None, help="Also write the images of each CSM release to this SQLite database, see csm_image_store.py. CSM releases that are no longer targeted are removed from it, releases written by other scripts are kept")
+    parser.add_argument("--manifest-repo-url", type=str, default=None, help="Clone the CSM manifest repo from this URL or path, instead of looking up the manifest-repo from the configuration on Github")
+    parser.add_argument("--trace-file", type=str, default=None, help="Write a Chrome trace event file with the time spent in each stage of the extraction, viewable in chrome://tracing or https://ui.perfetto.dev")
+    parser.add_argument("--watch", type=bool, default=False, action=argparse.BooleanOptionalAction, help="Keep running, and re-extract CSM branches whenever their head moves. The output file is only rewritten when it changes. Requires --cache-dir")
+    parser.add_argument("--watch-interval", type=int, default=300, help="Seconds in between checking for changes to the CSM branches in --watch mode")
+    parser.add_argument("--watch-events-file", type=str, default=None, help="Append a JSON line describing each change to the output to this file in --watch mode")
+    parser.add_argument("--on-change-command", type=str, default=None, help="Command to run whenever the output changes in --watch mode. It is passed the output file, and the changed CSM releases in $CHANGED_CSM_RELEASES")
+    parser.add_argument("--queue-size", type=int, default=16, help="Max number of items waiting in between each stage of the extraction pipeline")
+    parser.add_argument("--result-cache", type=bool, default=True, action=argparse.BooleanOptionalAction, help="Reuse the images found for a CSM branch in a previous run when neither the branch, configuration or helm charts have changed. Only applies when --cache-dir is set")
+    parser.add_argument("--partial-clone", type=bool, default=True, action=argparse.BooleanOptionalAction, help="Only download file contents from the CSM repo when they are read. Only applies when --cache-dir is set")
+
+    args = parser.parse_args()
+
     ####################
     # Load Configuration
     ####################
@@ -86,12 +1274,14 @@ if __name__ == '__main__':
             exit(1)
 
 
-    with open("csm-manifest-extractor-configuration.yaml") as stream:
+    with open("csm-manifest-extractor-configuration.yaml", 'rb') as stream:
+        config_data = stream.read()
         try:
-            config = yaml.safe_load(stream)
+            config = yaml.safe_load(config_data)
         except yaml.YAMLError as exc:
             logging.error(exc)
             exit(1)
+    config_hash = hashlib.sha256(config_data).hexdigest()
 
     g = Github(github_token)
 
@@ -100,195 +1290,59 @@ if __name__ == '__main__':
     logging.basicConfig(level=log_level)
     logging.info("load configuration")
 
+    # Report where the time went even when the extraction fails part way through
+    atexit.register(ReportTrace, args.trace_file)
+
     ####################
     # Download the CSM repo
     ####################
     logging.info("retrieve manifest repo")
 
     csm = config["configuration"]["manifest-repo"]
-    csm_repo_metadata = g.get_organization("Cray-HPE").get_repo(csm)
-    csm_dir = csm
-    # Clean up in case it exsts
-    if os.path.exists(csm_dir):
-        shutil.rmtree(csm_dir)
-
-    os.mkdir(csm_dir)
-    csm_repo = Repo.clone_from(csm_repo_metadata.clone_url, csm_dir)
-
-    ####################
-    # Go Get LIST of Docker Images we need to investigate!
-    ####################
-    logging.info("find docker images")
-    images_to_rebuild = {}
-    release_git_sha = {}
-    release_git_tags = {}
-
-    docker_image_tuples = []
-    for branch in config["configuration"]["targeted-csm-branches"]:
-        logging.info("Checking out CSM branch {} for docker image extraction".format(branch))
-
-        try:
-            csm_repo.git.checkout(branch)
-        except git.exc.GitCommandError as e:
-            logging.error(f'Failed to checkout branch "{branch}", skipping')
-            continue
-
-        release_git_sha[branch] = csm_repo.head.object.hexsha
-        release_git_tags[branch] = list(filter(lambda e: e != "", csm_repo.git.tag("--points-at", "HEAD").split("\n")))
-
-        # load the docker index file
-        docker_index = os.path.join(csm_dir, config["configuration"]["docker-image-manifest"])
-        with open(docker_index) as stream:
-            try:
-                manifest = yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                logging.error(exc)
-                exit(1)
+    if args.manifest_repo_url is not None:
+        clone_url = args.manifest_repo_url
+    else:
+        clone_url = g.get_organization("Cray-HPE").get_repo(csm).clone_url
+
+    if args.watch and args.cache_dir is None:
+        logging.error('--watch needs a CSM mirror to fetch changes into, and requires --cache-dir')
+        exit(1)
+
+    if args.cache_dir is not None:
+        if args.extraction_mode == "checkout":
+            logging.error('The "checkout" extraction mode requires a working tree, and can not be used with --cache-dir')
+            exit(1)
 
-        compare = config["docker-image-compare"]
-
-        ############################
-        # THis is some brittle logic!
-        ############################
-        # This ASSUMES that the docker/index.yaml file has no key depth greater than 3!
-        # This ASSUMES that all images are in artifactory.algol60.net/csm-docker/stable
-        # , it assume that '[' or ']' is part of the library, and NOT part of a legit value.
-        # compare the two dictionaries, get the changed values only.  Since the compare file has 'find_me' baked into all
-        # the values I care about, it should make it easier to find the actual image tags.
-        # perhaps there is some easier way to do this. or cleaner? Maybe I should have just used YQ and hard coded a lookup list
-        # I think it will be easier, cleaner if I provide a manual lookup between the image name and the repo in github.com\Cray-HPE;
-        # otherwise id have to do a docker inspect of some sort, which seems like a LOT of work
-
-        ddiff = DeepDiff(compare, manifest)
-        changed = ddiff["values_changed"]
-        docker_image_tuples = []
-        for k, v in changed.items():
-            path_to_digest = k
-            image_tag = v["new_value"]
-
-            full_docker_image_name = GetDockerImageFromDiff(k, image_tag)
-            docker_image_to_rebuild = FindImagePart(k)
-            docker_image_tuple = (full_docker_image_name, docker_image_to_rebuild, image_tag)
-            docker_image_tuples.append(docker_image_tuple)
-
-        # Reshape the data
-        docker_image_tuples = list(set(docker_image_tuples))
-        found_images = []
-        # Concert tuple to dict
-        for tuple in docker_image_tuples:
-            image = {}
-            image["full-image"] = tuple[0]
-            image["short-name"] = tuple[1]
-            image["image-tag"] = tuple[2]
-            found_images.append(image)
-
-        logging.info("\tCross reference docker images with lookup")
-        short_name_to_github_repo = {}
-        images_short_names_of_interest = []
-        for mapping in config["github-repo-image-lookup"]:
-            short_name_to_github_repo[mapping["image"]] = mapping["github-repo"]
-            images_short_names_of_interest.append(mapping["image"])
-
-        for found_image in found_images:
-            if found_image["short-name"] in images_short_names_of_interest:
-                logging.info("\tFound image {}".format(found_image))
+        csm_dir = os.path.join(args.cache_dir, csm + ".git")
+        with tracer.Span("fetch CSM mirror", "git clone", url=clone_url):
+            csm_repo = UpdateCSMMirror(clone_url, csm_dir, config["configuration"]["targeted-csm-branches"], args.partial_clone)
+    else:
+        csm_dir = csm
+        # Clean up in case it exsts
+        if os.path.exists(csm_dir):
+            shutil.rmtree(csm_dir)
 
-                # Create the Github repo, if not present
-                github_repo = short_name_to_github_repo[found_image["short-name"]]
-                if github_repo not in images_to_rebuild:
-                    images_to_rebuild[github_repo] = []
-
-                # Check to see if this is a new image
-                if found_image["full-image"] not in list(map(lambda e: e["full-image"], images_to_rebuild[github_repo])):
-                    # This is a new image
-                    found_image["csm-releases"] = [branch]
-                    images_to_rebuild[github_repo].append(found_image)
-                else:
-                    # Add the accompanying CSM release branch to an image that was already found in a different CSM release
-                    for image in images_to_rebuild[github_repo]:
-                        if found_image["full-image"] == image["full-image"]:
-                            image["csm-releases"].append(branch)
+        os.mkdir(csm_dir)
+        # Reading manifests out of the git object store does not need a working tree
+        with tracer.Span("clone CSM repo", "git clone", url=clone_url):
+            csm_repo = Repo.clone_from(clone_url, csm_dir, bare=(args.extraction_mode == "git-objects"))
 
     ####################
-    # Start to process helm charts
+    # Set up helm chart downloads
     ####################
-    charts_to_download = []
-    helm_lookup = config["helm-repo-lookup"]
-    logging.info("find helm charts")
-
-    all_charts = {}
-    for branch in config["configuration"]["targeted-csm-branches"]:
-        logging.info("Checking out CSM branch {} for helm chart image extraction".format(branch))
-        try:
-            csm_repo.git.checkout(branch)
-        except git.exc.GitCommandError as e:
-            logging.error(f'Failed to checkout branch "{branch}", skipping')
-            continue
-        
-        # its possible the same helm chart is referenced multiple times, so we should collapse the list
-        # example download link: https://artifactory.algol60.net/artifactory/csm-helm-charts/stable/cray-hms-bss/cray-hms-bss-2.0.4.tgz
-        # Ive added the helm-lookup struct because its a bunch of 'black magic' how the CSM repo knows where to download charts from
-        # the hms-hmcollector is the exception that broke the rule, so a lookup is needed.
-
-        helm_files = glob.glob(os.path.join(csm_dir, config["configuration"]["helm-manifest-directory"]) + "/*.yaml")
-        for helm_file in helm_files:
-            logging.info("Processing manifest {}".format(helm_file))
-            with open(helm_file) as stream:
-                try:
-                    manifest = yaml.safe_load(stream)
-                except yaml.YAMLError as exc:
-                    logging.error("Failed to parse manifest {}, error: {}".format(helm_file, exc))
-                    # If there is malformed manifest in the CSM manifest, then this entire workflow will fail.
-                    # TODO Instead we should make a best effort attempt at rebuilding images, but we should exist an non-zero exit code
-                    # to signal that not all images were rebuilt.
-                    continue
-            upstream_sources = {}
-            for chart in manifest["spec"]["sources"]["charts"]:
-                upstream_sources[chart["name"]] = chart["location"]
-            for chart in manifest["spec"]["charts"]:
-                chart_name = chart["name"]
-                chart_version = chart["version"]
-                if re.search(config["configuration"]["target-chart-regex"], chart["name"]) is not None:
-                    # TODO this is happy path only, im ignoring any mis-lookups; need to fix it!
-                    # TODO We are also ignore unlikely situations where different CSM releases pull the same helm chart version from different locations.
-                    download_url = None
-                    for repo in helm_lookup:
-                        if repo["chart"] == chart["name"]:
-                            download_url = urljoin(upstream_sources[chart["source"]],
-                                                              os.path.join(repo["path"], chart_name + "-" + str(
-                                                                  chart_version) + ".tgz"))
-
-                    # Save chart overrides
-                    # ASSUMPTION: It is being assumed that a HMS helm chart will be referenced only once in all loftsman manifests for any
-                    # CSM release. The following logic will need to change, if we every decide to deploy the same helm chart multiple times
-                    # with different release names.                   
-                    if chart_name not in all_charts:
-                        all_charts[chart_name] = {}
-                    if chart_version not in all_charts[chart_name]:
-                        all_charts[chart_name][chart_version] = {}
-                        all_charts[chart_name][chart_version]["csm-releases"] = {} 
-                        all_charts[chart_name][chart_version]["download-url"] = download_url
-    
-                    all_charts[chart_name][chart_version]["csm-releases"][branch] = {}
-                    if "values" in chart:
-                        all_charts[chart_name][chart_version]["csm-releases"][branch]["values"] = chart["values"]
-
-    # The following is really ugly, but prints out a nice summary of the chart overrides across all of the CSM branches this script it is looking at.
-    # This looks ugly, as I'm preferring to make the helm templating process later in this script nicer.
-    logging.info("Manifest value overrides")
-    manifest_values_overrides = {}
-    for branch in config["configuration"]["targeted-csm-branches"]:
-        manifest_values_overrides[branch] = {}
 
-        for chart_name, versions in all_charts.items():
-            for version_information in versions.values():
-                if branch in version_information["csm-releases"] and "values" in version_information["csm-releases"][branch]:
-                    manifest_values_overrides[branch][chart_name] = version_information["csm-releases"][branch]["values"]
-    logging.info("\n"+yaml.dump(manifest_values_overrides))
+    # Downloaded charts are kept in the cache directory, otherwise they only live for this run.
+    if args.cache_dir is not None:
+        chart_cache_dir = os.path.join(args.cache_dir, "helm-charts")
+        helm_repo_index_cache_dir = os.path.join(args.cache_dir, "helm-repo-indexes")
+    else:
+        chart_cache_dir = "helm_chart_downloads"
+        helm_repo_index_cache_dir = None
+        if os.path.exists(chart_cache_dir):
+            shutil.rmtree(chart_cache_dir)
 
-    ######
-    # Go download helm charts and explore them
-    ######
+    chart_downloader = ChartDownloader(chart_cache_dir, helm_repo_creds, args.download_workers)
+    helm_repo_index = HelmRepoIndex(chart_downloader, helm_repo_index_cache_dir)
 
     helm_dir = "helm_charts"
     # Clean up in case it exsts
@@ -296,189 +1350,35 @@ if __name__ == '__main__':
         shutil.rmtree(helm_dir)
 
     os.mkdir(helm_dir)
-    logging.info("download helm charts")
-    
-    # Extract all of the download links from the charts.
-    charts_to_download = []
-    for chart in all_charts.values():
-        charts_to_download.extend(list(map(lambda e: chart[e]["download-url"], chart)))
-
-    for chart in charts_to_download:
-        # Check to see if authentication is required for this helm repo
-        auth = None
-        url = urllib.parse.urlparse(chart)
-        if url.hostname in helm_repo_creds:
-            # Perform request with authentication
-            auth = requests.auth.HTTPBasicAuth(helm_repo_creds[url.hostname]["username"], helm_repo_creds[url.hostname]["password"])
-
-        # Download the helm chart!
-        r = requests.get(chart, stream=True, auth=auth)
-        if r.status_code != 200:
-            logging.error(f'Unexpected status code {r.status_code} when downloading chart {chart}')
-            exit(1)
-
-        chart_url = []
-        chart_url = chart.split('/')
-        file_name = chart_url[-1]
-        download_file_path = os.path.join(helm_dir, file_name)
-        # download started
-        with open(download_file_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    f.write(chunk)
-        # TODO need to check if the file downloaded or not
-
-        folder_name = file_name.replace('.tgz', '')
-        file = tarfile.open(download_file_path)
-        file.extractall(os.path.join(helm_dir, folder_name))
-        file.close()
-
-    logging.info("process helm charts")
-    # the structure is well known: {helm-chart}-version/{helm-chart}/all-the-goodness-we-want
-    for file in os.listdir(helm_dir):
-        helm_chart_dir = os.path.join(helm_dir, file)
-        if os.path.isdir(helm_chart_dir):
-            for entry in os.listdir(helm_chart_dir):
-                chart_dir = os.path.join(helm_chart_dir, entry)
-                if os.path.isdir(chart_dir):
-                    logging.info("Processing chart: {}".format(chart_dir))
-                    with open(os.path.join(chart_dir, "Chart.yaml")) as stream:
-                        try:
-                            chart = yaml.safe_load(stream)
-                        except yaml.YAMLError as exc:
-                            logging.error(exc)
-                            exit(1)
-                    with open(os.path.join(chart_dir, "values.yaml")) as stream:
-                        try:
-                            values = yaml.safe_load(stream)
-                        except yaml.YAMLError as exc:
-                            logging.error(exc)
-                            exit(1)
-                    # Do Some stuff with this chart info
-                    # THIS ASSUMES there is only one source and its the 0th one that we care about. I believe this is true for HMS
-                    source = chart["sources"][0]
-                    github_repo = source.split('/')[-1]
-                    logging.info("\tGithub repo: {}".format(github_repo))
-
-                    if github_repo not in images_to_rebuild:
-                        images_to_rebuild[github_repo] = []
-
-                    ## Assumed values.yaml structure
-                    # global:
-                    #  appVersion: 2.1.0
-                    #  testVersion: 2.1.0
-                    # tests:
-                    #  image:
-                    #    repository: artifactory.algol60.net/csm-docker/stable/cray-capmc-test
-                    #    pullPolicy: IfNotPresent
-                    #
-                    # image:
-                    #  repository: artifactory.algol60.net/csm-docker/stable/cray-capmc
-                    #  pullPolicy: IfNotPresent
-                    ### Its possible that there might not be a 'tests' value, but I will handle that.
-
-                    # Determine the names of the main application image, and the test image
-                    images_repos_of_interest = []
-                    if entry == "cray-power-control":
-                        images_repos_of_interest.append(values["cray-service"]["containers"]["cray-power-control"]["image"]["repository"])
-                    else:
-                        images_repos_of_interest.append(values["image"]["repository"])
-                    if "testVersion" in values["global"]:
-                        images_repos_of_interest.append(values["tests"]["image"]["repository"])
-
-                    logging.info("\tImage repos of interest:")
-                    for image_repo in images_repos_of_interest:
-                        logging.info("\t- {}".format(image_repo))
-
-                    # Now template the Helm chart to learn the image tags
-                    for branch in all_charts[chart["name"]][chart["version"]]["csm-releases"]:
-                        logging.info("\tCSM Branch {}".format(branch))
-                        chart_value_overrides = all_charts[chart["name"]][chart["version"]]["csm-releases"][branch].get("values")
-                        
-                        # Write out value overrides
-                        values_override_path = os.path.join(helm_chart_dir, "values-{}.yaml".format(branch.replace("/", "-")))
-                        logging.info("\t\tWriting out value overrides {}".format(values_override_path))
-                        with open(values_override_path, "w") as f:
-                            yaml.dump(chart_value_overrides, f)
-
-                        # TODO thought about inlining this script, but using shell=True can be dangerous.
-                        result = subprocess.run(["helm", "template", chart_dir, "-f", values_override_path], capture_output=True, text=True)
-                        if result.returncode != 0:
-                            logging.error("Failed to template helm chart. Exit code {}".format(result.returncode))
-                            logging.error("stderr: {}".format(result.stderr))
-                            logging.error("stdout: {}".format(result.stdout))
-                            exit(1)
-
-                        extracted_images = []
-                        for line in result.stdout.splitlines():
-                            m = re.match(' .+image: "?([a-zA-Z0-9:/\-.]+)"?', line)
-                            if m is None:
-                                continue
-
-                            extracted_images.append(m.group(1))
-                            image = m.group(1)
-
-                        logging.info("\t\tImages in use:")
-                        for image in extracted_images:
-                            image_repo, image_tag = image.split(":", 2)
-
-                            if image_repo not in images_repos_of_interest:
-                                continue
-                            logging.info("\t\t- {}".format(image))
-
-                            # Add the image to the list to be rebuilt if this is a new image
-                            if image not in list(map(lambda e: e["full-image"], images_to_rebuild[github_repo])):
-                                images_to_rebuild[github_repo].append({
-                                    "full-image": image,
-                                    "short-name": image_repo.split('/')[-1],
-                                    "image-tag": image_tag,
-                                    "csm-releases": [branch]
-                                })
-                            else:
-                                # Add the accompanying CSM release branch to an image that was already found in a different CSM release
-                                # TODO this seems to be not working'
-                                logging.info(f'Attempting to update CSM release for image {image} ')
-                                for image_to_rebuild in images_to_rebuild[github_repo]:
-                                    if image_to_rebuild["full-image"] == image and branch not in image_to_rebuild["csm-releases"]:
-                                        logging.info(f'Found match for {image} ')
-                                        image_to_rebuild["csm-releases"].append(branch)
-                                        break
-
 
-    #
-    # NEW LOGIC
-    #
-
-    all_images = {}
-    for github_repo in images_to_rebuild.values():
-        for image in github_repo:
-            image_repo, image_tag = image["full-image"].split(":", 2)
-
-            if image_repo not in all_images:
-                all_images[image_repo] = {}
-
-            all_images[image_repo][image_tag] = image["csm-releases"]
+    ####################
+    # Reuse results from previous runs for branches that have not changed
+    ####################
+    result_cache = {}
+    result_cache_path = None
+    if args.cache_dir is not None and args.result_cache:
+        result_cache_path = os.path.join(args.cache_dir, "extraction-results.json")
+        result_cache = LoadResultCache(result_cache_path)
 
-    images_by_csm_release = {}
-    for github_repo in images_to_rebuild.values():
-        for image in github_repo:
-            image_repo, image_tag = image["full-image"].split(":", 2)
+    ####################
+    # Extract docker images and helm charts from each CSM branch, then download and template the helm charts
+    ####################
+    logging.info("extract CSM branches")
+    pipeline = ExtractionPipeline(config, config_hash, chart_downloader, helm_repo_index, helm_dir, args.extraction_mode, args.branch_workers, args.render_workers, args.queue_size)
+    output_path = "csm-manifest-extractor-output.json"
 
-            for csm_release in image["csm-releases"]:
-                if csm_release not in images_by_csm_release:
-                    images_by_csm_release[csm_release] = {
-                        "images": {}
-                    }
+    if args.watch:
+        # Runs until interrupted
+        WatchCSMBranches(config, pipeline, csm_repo, csm_dir, clone_url, args.partial_clone, args.watch_interval, result_cache, result_cache_path, output_path, args.output_db, args.watch_events_file, args.on_change_command)
 
-                if image_repo not in images_by_csm_release[csm_release]:
-                    images_by_csm_release[csm_release]["images"][image_repo] = []
+    branch_results, chart_images = pipeline.Run(csm_repo, csm_dir, result_cache, config["configuration"]["targeted-csm-branches"])
 
-                images_by_csm_release[csm_release]["images"][image_repo].append(image_tag)
+    with tracer.Span("aggregate results", "aggregate"):
+        images_by_csm_release = BuildImagesByCSMRelease(config, branch_results, chart_images)
 
-    # Add in git information
-    for release_name in images_by_csm_release:
-        images_by_csm_release[release_name]["git_sha"] = release_git_sha[release_name]
-        images_by_csm_release[release_name]["git_tags"] = release_git_tags[release_name]
+    WriteOutput(output_path, args.output_db, images_by_csm_release)
 
-    with open('csm-manifest-extractor-output.json', 'w') as f:
-        json.dump(images_by_csm_release, f, indent=2)
+    if result_cache_path is not None:
+        logging.info(f'Saving result cache {result_cache_path}')
+        UpdateResultCache(result_cache, branch_results, images_by_csm_release)
+        SaveResultCache(result_cache_path, result_cache)
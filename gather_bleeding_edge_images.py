@@ -29,6 +29,7 @@ import json
 import yaml
 import docker
 
+import csm_image_store
 
 
 if __name__ == "__main__":
@@ -37,6 +38,7 @@ if __name__ == "__main__":
     #
     parser = argparse.ArgumentParser()
     parser.add_argument("--test-config-global", type=str, default="test_config_global.yaml",  help="Global test configuration file")
+    parser.add_argument("--output-db", type=str, default=None, help="Also write the bleeding-edge release to this SQLite database, see csm_image_store.py")
 
     args = parser.parse_args()
 
@@ -127,4 +129,8 @@ if __name__ == "__main__":
     }
 
     with open("bleeding-edge-image-versions.json", 'w') as f:
-        json.dump(output, f, indent=2)
\ No newline at end of file
+        json.dump(output, f, indent=2)
+
+    if args.output_db is not None:
+        print(f'Writing bleeding-edge release to {args.output_db}')
+        csm_image_store.write_releases(args.output_db, output, source="gather_bleeding_edge_images")
\ No newline at end of file
@@ -27,6 +27,8 @@ import yaml
 import json
 import pathlib
 
+import csm_image_store
+
 
 if __name__ == "__main__":
     #
@@ -34,6 +36,7 @@ if __name__ == "__main__":
     #
     parser = argparse.ArgumentParser()
     parser.add_argument("--csm-extractor-output-json", type=str, default="csm-manifest-extractor-output.json", help="Read in the json file created by the csm_manifest_extractor.py")
+    parser.add_argument("--csm-extractor-output-db", type=str, default=None, help="Read in the SQLite database created by the csm_manifest_extractor.py instead of --csm-extractor-output-json")
     parser.add_argument("--csm-release", type=str, default="main", help="CSM release branch to target")
     parser.add_argument("--allure-dir", type=str, default="./allure",  help="Allure output director")
     parser.add_argument("--github-action-id", type=str, default="", help="Github Action run ID")
@@ -46,25 +49,22 @@ if __name__ == "__main__":
     allure_dir = pathlib.Path(args.allure_dir)
     allure_dir.mkdir(parents=True, exist_ok=True)
 
-    # Read in the json file created by the csm_manifest_extractor.py
-    csm_extractor_output = None
-    with open(args.csm_extractor_output_json, 'r') as f:
-        csm_extractor_output = json.load(f)
-
-    if args.csm_release not in csm_extractor_output:
-        print(f'Error provided CSM release does not exist in {args.csm_extractor_output_json}')
+    # Read in the CSM release from the output of the csm_manifest_extractor.py
+    csm_release = csm_image_store.load_release(args.csm_release, args.csm_extractor_output_json, args.csm_extractor_output_db)
+    if csm_release is None:
+        print(f'Error provided CSM release does not exist in {args.csm_extractor_output_db or args.csm_extractor_output_json}')
         exit(1)
 
-    images = csm_extractor_output[args.csm_release]["images"]
+    images = csm_release["images"]
 
 
     #
     # Write out test metadata
     #
     test_metadata = {
-        "git_sha": csm_extractor_output[args.csm_release]["git_sha"],
-        "git_tags": csm_extractor_output[args.csm_release]["git_tags"],
-        "images": csm_extractor_output[args.csm_release]["images"],
+        "git_sha": csm_release["git_sha"],
+        "git_tags": csm_release["git_tags"],
+        "images": csm_release["images"],
         "github_action_run_url": None,
         "step_outcomes": {
             "standup_simulation_environment": args.step_outcome_standup_simulation_environment,
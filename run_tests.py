@@ -22,7 +22,12 @@
 # ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 import argparse
+import concurrent.futures
+import contextlib
 import docker
+import gzip
+import hashlib
+import itertools
 import json
 import shutil
 import pathlib
@@ -31,56 +36,459 @@ import subprocess
 import yaml
 import multiprocessing as mp
 import re
+import tarfile
+import threading
+import time
+
+import csm_image_store
+
+@contextlib.contextmanager
+def atomic_write(path: pathlib.Path, mode: str = 'w', opener=open):
+    # Write to a temporary file next to path and only move it into place once it is complete, so an interrupted run
+    # never leaves a partially written file behind
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        with opener(tmp_path, mode) as f:
+            yield f
+        tmp_path.replace(path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
 
 # Inspect each container image to learn what tests it supports
-def list_image_files(docker_client: docker.DockerClient, image: str) -> list[str]:
+def list_container_files_export(container):
+    # List every file in the container by streaming its entire filesystem. Paths are yielded as tar lists them, so
+    # the listing is never held in memory.
+    export = subprocess.Popen(["docker", "export", container.name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    listing = subprocess.Popen(["tar", "-t"], stdin=export.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Let docker export see a broken pipe if tar exits early
+    export.stdout.close()
+    for file in listing.stdout:
+        yield file.rstrip("\n")
+
+    listing_stderr = listing.stderr.read()
+    listing.wait()
+    export_stderr = export.stderr.read().decode()
+    export.wait()
+
+    if export.returncode != 0:
+        print("Failed to export container. Exit code {}".format(export.returncode))
+        print("stderr: {}".format(export_stderr))
+        exit(1)
+
+    if listing.returncode != 0:
+        print("Failed to extract files from container. Exit code {}".format(listing.returncode))
+        print("stderr: {}".format(listing_stderr))
+        exit(1)
+
+class ChunkReader:
+    # File object over an iterator of byte chunks, such as the archive stream returned by the docker SDK
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b""
+        self.offset = 0
+
+    def read(self, size=-1):
+        data = []
+        while size != 0:
+            if self.offset == len(self.chunk):
+                self.chunk = next(self.chunks, b"")
+                self.offset = 0
+                if len(self.chunk) == 0:
+                    break
+
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.offset + size)
+            data.append(self.chunk[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+
+        return b"".join(data)
+
+def list_container_files_subtree(container, path: str):
+    # Only stream the directory of interest out of the container. The archive has paths relative to the parent
+    # directory, so /src/app/smoke.json is listed as app/smoke.json. Put the parent back, so the listing is the same
+    # as the one from docker export.
+    parent = os.path.dirname(path.rstrip("/")).lstrip("/")
+
+    try:
+        stream, _ = container.get_archive(path)
+    except docker.errors.NotFound:
+        # No tests in this image
+        print(f"  {path} does not exist in the image")
+        return
+
+    with tarfile.open(fileobj=ChunkReader(stream), mode="r|") as archive:
+        for member in archive:
+            file = f'{parent}/{member.name}'
+            yield f'{file}/' if member.isdir() else file
+
+class HashingReader:
+    # Hash everything read from a file object, used to work out the diff ID of a layer while it is being listed
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+def layer_index_path(layer_index_dir: pathlib.Path, diff_id: str) -> pathlib.Path:
+    return layer_index_dir.joinpath(diff_id.replace(":", "-") + ".gz")
+
+def read_layer_index(layer_index_dir: pathlib.Path, diff_id: str) -> list[str]:
+    with gzip.open(layer_index_path(layer_index_dir, diff_id), 'rt') as f:
+        return f.read().splitlines()
+
+def write_layer_index(layer_index_dir: pathlib.Path, diff_id: str, files: list[str]):
+    with atomic_write(layer_index_path(layer_index_dir, diff_id), 'wt', opener=gzip.open) as f:
+        f.write("\n".join(files))
+
+def layer_alias_path(layer_index_dir: pathlib.Path, member_name: str) -> pathlib.Path:
+    return layer_index_dir.joinpath("alias-" + hashlib.sha256(member_name.encode()).hexdigest())
+
+def open_layer(fileobj):
+    # Layers are plain tars with the classic image store, but compressed blobs with the containerd image store. The
+    # diff ID is the sha256 of the uncompressed tar, so decompress here rather than with tarfile's "r|*", which would
+    # only give us the compressed bytes to hash.
+    magic = fileobj.read(2)
+    stream = ChunkReader(itertools.chain([magic], iter(lambda: fileobj.read(1024 * 1024), b"")))
+    if magic == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+def index_image_layers(image: str, layer_index_dir: pathlib.Path, diff_ids: set[str]):
+    # docker save streams every layer of the image. Only the layers in diff_ids are listed and hashed, everything else
+    # is skipped over without being read:
+    #  - OCI blobs are named after their digest, which is the diff ID for uncompressed layers
+    #  - other layers (compressed blobs, <id>/layer.tar) are identified by hashing them once, after which an alias from
+    #    their name in the archive to the diff ID is kept next to the index
+    # The stream is stopped as soon as every missing layer has been indexed. A miss still costs reading the archive up to
+    # the last new layer, as docker save has no way to export only some layers.
+    missing_diff_ids = set(diff_ids)
+    save = subprocess.Popen(["docker", "save", image], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=save.stdout, mode="r|") as archive:
+            for member in archive:
+                if len(missing_diff_ids) == 0:
+                    break
+                if not member.isfile():
+                    continue
+
+                diff_id = None
+                if member.name.startswith("blobs/sha256/"):
+                    diff_id = "sha256:" + os.path.basename(member.name)
+                    if diff_id not in missing_diff_ids and not layer_index_path(layer_index_dir, diff_id).exists():
+                        # Not an uncompressed layer, it may still be a compressed one
+                        diff_id = None
+                if diff_id is None and layer_alias_path(layer_index_dir, member.name).exists():
+                    diff_id = layer_alias_path(layer_index_dir, member.name).read_text()
+                if diff_id is not None and diff_id not in missing_diff_ids:
+                    # Already indexed
+                    continue
+
+                reader = HashingReader(open_layer(archive.extractfile(member)))
+                files = []
+                try:
+                    with tarfile.open(fileobj=reader, mode="r|") as layer:
+                        for entry in layer:
+                            file = entry.name.removeprefix("./").lstrip("/")
+                            files.append(f'{file}/' if entry.isdir() else file)
+                except tarfile.ReadError:
+                    # manifest.json, the image config and other metadata
+                    continue
+
+                # Read the end of archive padding, so the hash covers the whole layer
+                while reader.read(1024 * 1024):
+                    pass
+
+                diff_id = f'sha256:{reader.sha256.hexdigest()}'
+                if not member.name.startswith("blobs/sha256/") or os.path.basename(member.name) != diff_id.split(":")[1]:
+                    with atomic_write(layer_alias_path(layer_index_dir, member.name)) as f:
+                        f.write(diff_id)
+                if diff_id in missing_diff_ids:
+                    write_layer_index(layer_index_dir, diff_id, files)
+                    missing_diff_ids.discard(diff_id)
+    finally:
+        stopped_early = save.poll() is None and len(missing_diff_ids) == 0
+        if stopped_early:
+            save.kill()
+        save.stdout.close()
+        save_stderr = save.stderr.read().decode()
+        save.wait()
+
+    if save.returncode != 0 and not stopped_early:
+        print("Failed to save image {}. Exit code {}".format(image, save.returncode))
+        print("stderr: {}".format(save_stderr))
+        exit(1)
+
+def apply_layers(layers: list[list[str]]) -> list[str]:
+    # Stack the layers on top of each other, like the overlay filesystem of a container would. A whiteout hides a file
+    # or directory of the layers below, and an opaque whiteout hides everything that was in its directory.
+    files = {}
+    for layer_files in layers:
+        hidden = set()
+        hidden_prefixes = []
+        for file in layer_files:
+            directory, name = os.path.split(file.rstrip("/"))
+            prefix = f'{directory}/' if directory else ""
+            if name == ".wh..wh..opq":
+                hidden_prefixes.append(prefix)
+            elif name.startswith(".wh."):
+                hidden.add(prefix + name[len(".wh."):])
+                hidden_prefixes.append(prefix + name[len(".wh."):] + "/")
+
+        if len(hidden) != 0 or len(hidden_prefixes) != 0:
+            files = {
+                file: None for file in files
+                if file.rstrip("/") not in hidden and not any(file.startswith(prefix) and file != prefix for prefix in hidden_prefixes)
+            }
+
+        for file in layer_files:
+            if not os.path.basename(file.rstrip("/")).startswith(".wh."):
+                files[file] = None
+
+    return list(files)
+
+def list_image_files_layers(docker_client: docker.DockerClient, image: str, layer_index_dir: pathlib.Path) -> list[str]:
+    # All of the hmth-test images share the same base layers, so each layer is only listed once and its entries are
+    # kept in layer_index_dir. An image whose layers are all indexed costs nothing but reading the index. A new image
+    # only needs its new layers to be listed, see index_image_layers for what that costs.
+    diff_ids = docker_client.images.get(image).attrs["RootFS"]["Layers"]
+
+    layer_index_dir.mkdir(parents=True, exist_ok=True)
+    missing_diff_ids = {diff_id for diff_id in diff_ids if not layer_index_path(layer_index_dir, diff_id).exists()}
+    if len(missing_diff_ids) != 0:
+        print(f"  Indexing {len(missing_diff_ids)} of {len(diff_ids)} layers")
+        index_image_layers(image, layer_index_dir, missing_diff_ids)
+
+    for diff_id in diff_ids:
+        if not layer_index_path(layer_index_dir, diff_id).exists():
+            print(f"Failed to find layer {diff_id} of image {image} in the output of docker save, it may be compressed in a format that is not supported")
+            exit(1)
+
+    return apply_layers([read_layer_index(layer_index_dir, diff_id) for diff_id in diff_ids])
+
+def list_image_files(docker_client: docker.DockerClient, image: str, discovery_backend: str = "subtree", layer_index_dir: pathlib.Path = None):
+    # Yields the path of each file in the image
+    if discovery_backend == "layers":
+        # Works from the image layers, no container is needed
+        yield from list_image_files_layers(docker_client, image, layer_index_dir)
+        return
+
     # Inspect the container image, without actually running it to determine if this this is a valid image
     container = docker_client.containers.create(image)
 
-    result = subprocess.run(f'docker export {container.name} | tar -t', shell=True, capture_output=True, text=True)
-    if result.returncode != 0:
-        print("Failed to extract files from container. Exit code {}".format(result.returncode))
-        print("stderr: {}".format(result.stderr))
-        print("stdout: {}".format(result.stdout))
-        exit(1)
+    # Always clean up the container, even if listing its files failed
+    try:
+        if discovery_backend == "export":
+            yield from list_container_files_export(container)
+        else:
+            yield from list_container_files_subtree(container, "/src/app")
+    finally:
+        container.remove()
+
+def build_test_file_matcher(wanted_tests: list, tavern_configs: dict):
+    # Combine the test and tavern config patterns into a single regex, so each file is matched once instead of once
+    # per pattern. The name of the group that matched says what was found.
+    patterns = []
+    groups = {}
+    for i, (file_regex, test_class) in enumerate(wanted_tests):
+        patterns.append(f'(?P<test{i}>{file_regex.pattern})')
+        groups[f'test{i}'] = ("test", test_class)
+    for i, (file, tavern_config) in enumerate(tavern_configs.items()):
+        patterns.append(f'(?P<tavern{i}>^{re.escape(file)}$)')
+        groups[f'tavern{i}'] = ("tavern-config", tavern_config)
+
+    return re.compile("|".join(patterns)), groups
+
+def detect_image_tests(docker_client: docker.DockerClient, image: str, test_file_matcher: tuple, discovery_backend: str, layer_index_dir: pathlib.Path = None) -> dict:
+    image_tests = {
+        "tests": [],
+        "tavern-configs": []
+    }
+
+    test_file_regex, test_file_groups = test_file_matcher
+    for file in list_image_files(docker_client, image, discovery_backend, layer_index_dir):
+        # Tests and test configurations only live in the app directory, so skip everything else without a regex
+        if not file.startswith("src/app/"):
+            continue
+
+        match = test_file_regex.match(file)
+        if match is None:
+            continue
+
+        kind, value = test_file_groups[match.lastgroup]
+        if kind == "test":
+            # We have a match!
+            print(f"  Found test at {str(file)}")
+            print(f"    Class:     {value}")
+
+            test_dir = pathlib.Path(file).stem
+            print(f"    Directory: {test_dir}")
+
+            image_tests["tests"].append([value, test_dir])
+        else:
+            # Look for test configurations
+            print(f"  Found tavern config file: {str(file)}")
+            image_tests["tavern-configs"].append(value)
+
+    return image_tests
 
-    container.remove()
+def discovery_patterns_hash(wanted_tests: list, tavern_configs: dict) -> str:
+    # Anything cached with different patterns is no longer valid
+    patterns = {
+        "wanted_tests": [[file_regex.pattern, test_class] for file_regex, test_class in wanted_tests],
+        "tavern_configs": tavern_configs
+    }
+    return hashlib.sha256(json.dumps(patterns, sort_keys=True).encode()).hexdigest()
 
-    return result.stdout.splitlines()
+def load_discovery_cache(discovery_cache_path: pathlib.Path, patterns_hash: str) -> dict:
+    if not discovery_cache_path.exists():
+        return {}
+
+    try:
+        with open(discovery_cache_path, 'r') as f:
+            discovery_cache = json.load(f)
+    except json.JSONDecodeError as e:
+        print(f'Ignoring corrupted test discovery cache {str(discovery_cache_path)}: {e}')
+        return {}
+
+    if discovery_cache.get("patterns") != patterns_hash:
+        print("Test discovery patterns have changed, ignoring test discovery cache")
+        return {}
+
+    return discovery_cache["images"]
+
+def save_discovery_cache(discovery_cache_path: pathlib.Path, patterns_hash: str, images: dict):
+    discovery_cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_write(discovery_cache_path) as f:
+        json.dump({"patterns": patterns_hash, "images": images}, f, indent=2)
+
+def pull_image(docker_client: docker.DockerClient, image: str, pull_retries: int):
+    for attempt in range(1, pull_retries + 2):
+        print(f'Pulling {image} (attempt {attempt}/{pull_retries + 1})')
+        start = time.monotonic()
+        try:
+            docker_client.images.pull(image)
+            print(f'Pulled {image} in {time.monotonic() - start:.1f}s')
+            return
+        except docker.errors.NotFound as e:
+            # Retrying won't make a missing image appear
+            print(f'Failed to pull {image}: {e}')
+            exit(1)
+        except docker.errors.APIError as e:
+            print(f'Failed to pull {image}: {e}')
+            if attempt > pull_retries:
+                exit(1)
+
+            # Back off before trying again, in case the registry is overloaded
+            time.sleep(2 ** attempt)
+
+def pull_images(docker_client: docker.DockerClient, images: list[str], pull_workers: int, pull_retries: int):
+    # Pull the images in parallel, and yield each image as soon as its pull has finished, so tests can be detected in
+    # it while the other images are still being pulled
+    with concurrent.futures.ThreadPoolExecutor(max_workers=pull_workers) as executor:
+        futures = {executor.submit(pull_image, docker_client, image, pull_retries): image for image in images}
+        for pulled, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            future.result()
+            print(f'Pulled {pulled}/{len(futures)} images')
+            yield futures[future]
+
+def detect_test_classes(docker_client: docker.DockerClient, images: list[str], tests_dir: pathlib.Path, wanted_tests: list, tavern_configs: dict, discovery_backend: str, discovery_cache_path: pathlib.Path = None, layer_index_dir: pathlib.Path = None, ready_images=None):
+    # ready_images yields the images in the order they become available, such as from pull_images. Tests are
+    # reported in the order of images regardless.
+    if ready_images is None:
+        ready_images = images
 
-def detect_test_classes(docker_client: docker.DockerClient, images: list[str], tests_dir: pathlib.Path, wanted_tests: list, tavern_configs: dict):
     test_results = {}
     tavern_config_results = {}
 
-    for image in images:
+    # The tests in an image only change when the image does, so they are cached by image ID
+    patterns_hash = discovery_patterns_hash(wanted_tests, tavern_configs)
+    test_file_matcher = build_test_file_matcher(wanted_tests, tavern_configs)
+    discovery_cache = {}
+    if discovery_cache_path is not None:
+        discovery_cache = load_discovery_cache(discovery_cache_path, patterns_hash)
+
+    tests_by_image = {}
+    for image in ready_images:
         print(f"Detecting tests in {image}")
-        tavern_config_results[image] = []
-        for file in list_image_files(docker_client, image):
-            # Look for files that determine what tests are present
-            for file_regex, test_class in wanted_tests:
-                if not file_regex.match(file):
-                    continue
-    
-                # We have a match!
-                print(f"  Found test at {str(file)}")
-                print(f"    Class:     {test_class}")
-                if test_class not in test_results:
-                    test_results[test_class] = []
+        image_id = docker_client.images.get(image).id
+        if image_id in discovery_cache:
+            print(f"  Using cached tests for image {image_id}")
+            image_tests = discovery_cache[image_id]
+            for test_class, test_dir in image_tests["tests"]:
+                print(f"  Found test {test_class} in directory {test_dir}")
+        else:
+            image_tests = detect_image_tests(docker_client, image, test_file_matcher, discovery_backend, layer_index_dir)
+            discovery_cache[image_id] = image_tests
 
-                test_dir = pathlib.Path(file).stem
-                print(f"    Directory: {test_dir}")
+        tests_by_image[image] = image_tests
 
+    for image in images:
+        image_tests = tests_by_image[image]
+        tavern_config_results[image] = list(image_tests["tavern-configs"])
+        for test_class, test_dir in image_tests["tests"]:
+            if test_class not in test_results:
+                test_results[test_class] = []
 
-                test_results[test_class].append((test_dir, image))
-            
-            # Look for test configurations
-            if file in tavern_configs:
-                print(f"  Found tavern config file: {str(file)}")
-                tavern_config_results[image].append(tavern_configs[str(file)])
+            test_results[test_class].append((test_dir, image))
+
+    if discovery_cache_path is not None:
+        save_discovery_cache(discovery_cache_path, patterns_hash, discovery_cache)
 
     return test_results, tavern_config_results
 
-def run_tests(test_global_test_config: dict, detected_tavern_configs, tests: list[dict], allure_report_dir: pathlib.Path):
+def build_test_stages(tests: list[dict], concurrent_test_classes: list[str]) -> list[dict]:
+    # Turn the ordered list of tests into stages that are run one after another. Neighbouring tests with a test class
+    # that is safe to run at the same time as other tests are merged into a single concurrent stage. Every other test
+    # is a barrier: it only starts once everything before it has finished, and runs one image at a time.
+    stages = []
+    for test in tests:
+        is_concurrent = test["test_class"] in concurrent_test_classes
+        if is_concurrent and len(stages) != 0 and stages[-1]["concurrent"]:
+            stages[-1]["tests"].append(test)
+        else:
+            stages.append({"concurrent": is_concurrent, "tests": [test]})
+
+    return stages
+
+def run_test_job(job: dict) -> subprocess.CompletedProcess:
+    # Capture the output, so the output of tests running at the same time doesn't get mixed together
+    return subprocess.run(job["cmd"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+def warm_container_name(image: str) -> str:
+    short_name = os.path.basename(image.split(":", 2)[0])
+    return f'{short_name}-warm-{hashlib.sha256(image.encode()).hexdigest()[:12]}'
+
+def start_warm_container(image: str, container_args: list[str]):
+    # Keep a container of the test image running without starting any tests in it, so each test suite can be run in
+    # it with docker exec instead of creating a new container and attaching it to the network every time
+    name = warm_container_name(image)
+
+    # Clean up a container left behind by an earlier run that didn't get to stop it
+    subprocess.run(["docker", "rm", "-f", name], capture_output=True)
+
+    print(f'Starting warm container {name} for {image}')
+    cmd = ["docker", "run", "-d", "--rm", "--name", name] + container_args + ["--entrypoint", "tail", image, "-f", "/dev/null"]
+    print("Command:", ' '.join(cmd))
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        print("Failed to start warm container for {}. Exit code {}".format(image, result.returncode))
+        print("stderr: {}".format(result.stderr))
+        exit(1)
+
+def stop_warm_container(image: str):
+    name = warm_container_name(image)
+    print(f'Stopping warm container {name}')
+    result = subprocess.run(["docker", "rm", "-f", name], capture_output=True, text=True)
+    if result.returncode != 0:
+        print("Failed to stop warm container {}. Exit code {}".format(name, result.returncode))
+        print("stderr: {}".format(result.stderr))
+
+def run_tests(docker_client: docker.DockerClient, test_global_test_config: dict, detected_tavern_configs, tests: list[dict], allure_report_dir: pathlib.Path, test_workers: int, warm_containers: bool = False):
     # Remove existing reports
     if allure_report_dir.exists():
         shutil.rmtree(allure_report_dir)
@@ -108,15 +516,28 @@ def run_tests(test_global_test_config: dict, detected_tavern_configs, tests: lis
     print("Smoke test host overrides")
     print(json.dumps(smoke_host_override, indent=2))
 
+    # Every test container is started with the same arguments
+    container_args = [
+        "--network", "hms-simulation-environment_simulation",   # Connect to the simulation network 
+        "-v", f'{str(allure_report_dir.absolute())}:/allure-results/', # Location to output the allure results
+        "-v", f'{str(tavern_global_config_path.absolute())}:/tavern_global_config.yaml', # Tavern configuration
+        "--user", "root"
+    ]
+
+    # docker exec doesn't go through the entrypoint of the image like docker run does, so it has to be run explicitly
+    test_images = list(dict.fromkeys(image for test in tests for image in test["images"]))
+    image_entrypoints = {}
+    if warm_containers:
+        for image in test_images:
+            image_entrypoints[image] = docker_client.images.get(image).attrs["Config"]["Entrypoint"] or []
+
+    # Build up the command to run for each image of each test
+    jobs = {}
     for test in tests:
         test_class = test["test_class"]
+        jobs[test["test_name"]] = []
 
-        print("========================================")
-        print(f'Running {test["test_name"]} tests')
-        print("========================================")
-        
         for image, test_dir in test["images"].items():
-            print(f'Running {image}')
             image_repo, image_tag = image.split(":", 2)
             short_name = os.path.basename(image_repo)
 
@@ -142,89 +563,311 @@ def run_tests(test_global_test_config: dict, detected_tavern_configs, tests: lis
                 test_args = ['tavern', '--config', tavern_config, '--path', f'/src/app/api/{test_dir}']
 
             if test_args is None:
-                print("Skipping unsupported test")
+                print(f'Skipping unsupported test {test["test_name"]} for {image}')
                 continue
 
-            cmd = ["docker", "run", "--rm", "-t", 
-                "--network", "hms-simulation-environment_simulation",   # Connect to the simulation network 
-                "-v", f'{str(allure_dir.absolute())}:/allure-results/', # Location to output the allure results
-                "-v", f'{str(tavern_global_config_path.absolute())}:/tavern_global_config.yaml', # Tavern configuration
-                "--user", "root"
-            ] + [image] + test_args + [f'--allure-dir=/allure-results/{short_name}/{test_class}']
+            test_args = test_args + [f'--allure-dir=/allure-results/{short_name}/{test_class}']
+            if warm_containers:
+                cmd = ["docker", "exec", "-t", warm_container_name(image)] + image_entrypoints[image] + test_args
+            else:
+                cmd = ["docker", "run", "--rm", "-t"] + container_args + [image] + test_args
 
-            print("Command:", ' '.join(cmd))
+            jobs[test["test_name"]].append({"test_name": test["test_name"], "image": image, "cmd": cmd})
 
-            result = subprocess.run(cmd)
-            if result.returncode != 0:
-                print("Tests failed. Exit code {}".format(result.returncode))
-                continue
+    # Warm containers are always stopped, even if running the tests failed
+    started_images = []
+    try:
+        if warm_containers:
+            for image in test_images:
+                started_images.append(image)
+                start_warm_container(image, container_args)
 
-def process_allure_reports(allure_report_dir: pathlib.Path):
-    for test_result_path in allure_report_dir.glob("**/*result.json"):
-        test_source = test_result_path.parent.parent.name
-        test_class = test_result_path.parent.name
-        print(f'Processing test result: {str(test_result_path)}') 
-        
-        # Read in test result file
-        test_result = None
-        with open(test_result_path, 'r') as f:
-            test_result = json.load(f)
+        run_test_stages(test_global_test_config, tests, jobs, test_workers)
+    finally:
+        for image in started_images:
+            stop_warm_container(image)
 
-        # Fix the suite name, and also add a parent suite. 
-        # This will create an hierarchy of:
-        # service_name:
-        # -> smoke
-        # -> 1-non-disruptive
-        # -> 2-disruptive
-        # etc...
-        parent_suite_exists = False;
-        for label in test_result["labels"]:
-            if label["name"] == "suite":
-                label["value"] = test_class
-            elif label["name"] == "parentSuite":
-                label["value"] = test_source
-                parent_suite_exists = True
-
-        if not parent_suite_exists:
-            test_result["labels"].append({
-                "name": "parentSuite",
-                "value": test_source
-            })
-
-        # Hack: Change broken to failed.
-        # Due to how tavern produced exceptions they show up as broken in allure
-        if test_result["status"] == "broken":
-            test_result["status"] = "failed"
-        if "steps" in test_result:
-            for step in test_result["steps"]:
-                if step["status"] == "broken":
-                    step["status"] = "failed"
-
-        # Write the data back out
-        with open(test_result_path, 'w') as f:
-            json.dump(test_result, f, indent=2)
+def run_test_stages(test_global_test_config: dict, tests: list[dict], jobs: dict, test_workers: int):
+    for stage in build_test_stages(tests, test_global_test_config.get("concurrent_test_classes", [])):
+        stage_jobs = [job for test in stage["tests"] for job in jobs[test["test_name"]]]
 
-    # Move test reports into toplevel directory
-    for file in allure_report_dir.glob("**/*"):
-        if not file.is_file(): 
+        if stage["concurrent"] and test_workers > 1:
+            print("========================================")
+            print(f'Running {", ".join(test["test_name"] for test in stage["tests"])} tests concurrently')
+            print("========================================")
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=test_workers) as executor:
+                futures = {}
+                for job in stage_jobs:
+                    print(f'Starting {job["test_name"]} tests for {job["image"]}')
+                    print("Command:", ' '.join(job["cmd"]))
+                    futures[executor.submit(run_test_job, job)] = job
+
+                for future in concurrent.futures.as_completed(futures):
+                    job = futures[future]
+                    result = future.result()
+
+                    print("----------------------------------------")
+                    print(f'Output of {job["test_name"]} tests for {job["image"]}')
+                    print("----------------------------------------")
+                    print(result.stdout)
+                    if result.returncode != 0:
+                        print("Tests failed. Exit code {}".format(result.returncode))
             continue
+
+        for test in stage["tests"]:
+            print("========================================")
+            print(f'Running {test["test_name"]} tests')
+            print("========================================")
+
+            for job in jobs[test["test_name"]]:
+                print(f'Running {job["image"]}')
+                print("Command:", ' '.join(job["cmd"]))
+
+                result = subprocess.run(job["cmd"])
+                if result.returncode != 0:
+                    print("Tests failed. Exit code {}".format(result.returncode))
+                    continue
+
+def fix_allure_result(test_result: dict, test_source: str, test_class: str) -> bool:
+    # Returns whether the test result was changed
+    changed = False
+
+    # Fix the suite name, and also add a parent suite. 
+    # This will create an hierarchy of:
+    # service_name:
+    # -> smoke
+    # -> 1-non-disruptive
+    # -> 2-disruptive
+    # etc...
+    parent_suite_exists = False;
+    for label in test_result["labels"]:
+        if label["name"] == "suite" and label["value"] != test_class:
+            label["value"] = test_class
+            changed = True
+        elif label["name"] == "parentSuite":
+            if label["value"] != test_source:
+                label["value"] = test_source
+                changed = True
+            parent_suite_exists = True
+
+    if not parent_suite_exists:
+        test_result["labels"].append({
+            "name": "parentSuite",
+            "value": test_source
+        })
+        changed = True
+
+    # Hack: Change broken to failed.
+    # Due to how tavern produced exceptions they show up as broken in allure
+    if test_result["status"] == "broken":
+        test_result["status"] = "failed"
+        changed = True
+    if "steps" in test_result:
+        for step in test_result["steps"]:
+            if step["status"] == "broken":
+                step["status"] = "failed"
+                changed = True
+
+    return changed
+
+def rename_allure_attachments(node: dict, renamed_files: dict) -> bool:
+    # Point attachments at their new names, anywhere in a test result or container. Returns whether anything changed.
+    changed = False
+    for attachment in node.get("attachments", []):
+        if attachment.get("source") in renamed_files:
+            attachment["source"] = renamed_files[attachment["source"]]
+            changed = True
+
+    for key in ["steps", "befores", "afters"]:
+        for child in node.get(key, []):
+            changed = rename_allure_attachments(child, renamed_files) or changed
+
+    return changed
+
+def process_allure_result(task: tuple) -> bool:
+    # Fix up a single test result or container, and move it to its destination in the same step. Returns whether it
+    # was rewritten.
+    test_result_path, destination, test_source, test_class, renamed_files = task
+
+    with open(test_result_path, 'r') as f:
+        test_result = json.load(f)
+
+    changed = rename_allure_attachments(test_result, renamed_files)
+    if test_result_path.name.endswith("result.json"):
+        changed = fix_allure_result(test_result, test_source, test_class) or changed
+
+    if not changed:
+        test_result_path.rename(destination)
+        return False
+
+    with atomic_write(destination) as f:
+        json.dump(test_result, f)
+    test_result_path.unlink()
+    return True
+
+def process_allure_reports(allure_report_dir: pathlib.Path):
+    # Walk the results once. Files already in the top level directory keep their names, so they are claimed first.
+    files = []
+    for dirpath, _, filenames in os.walk(allure_report_dir):
+        files.extend(pathlib.Path(dirpath) / filename for filename in filenames)
+    files.sort(key=lambda file: (file.parent != allure_report_dir, str(file)))
+
+    # Work out where each file is moved to in the top level directory. A file with the same name as one that is already
+    # there is given a name based on the directory it came from, instead of overwriting it. Attachments are referenced
+    # by name from the test results and containers next to them, so those are kept track of per directory.
+    destinations = {}
+    claimed = set()
+    renamed_files = {}
+    for file in files:
+        relative_dir = file.parent.relative_to(allure_report_dir)
         destination = allure_report_dir / file.name
-        print(f'Moving {str(file)} -> {str(destination)}')
+        if destination in claimed:
+            disambiguated_name = "-".join(relative_dir.parts + (file.name,))
+            destination = allure_report_dir / disambiguated_name
+            suffix = 1
+            while destination in claimed:
+                destination = allure_report_dir / f'{suffix}-{disambiguated_name}'
+                suffix += 1
+            print(f'Found more than one {file.name}, moving {str(file)} -> {str(destination)} instead')
+            renamed_files.setdefault(file.parent, {})[file.name] = destination.name
+        destinations[file] = destination
+        claimed.add(destination)
+
+    moves = []
+    result_tasks = []
+    for file, destination in destinations.items():
+        if file.parent == allure_report_dir:
+            # Already in the top level directory, and processed
+            continue
+
+        if file.name.endswith("result.json"):
+            # Test results are in <allure dir>/<test source>/<test class>/
+            result_tasks.append((file, destination, file.parent.parent.name, file.parent.name, renamed_files.get(file.parent, {})))
+        elif file.name.endswith("container.json") and file.parent in renamed_files:
+            result_tasks.append((file, destination, None, None, renamed_files[file.parent]))
+        else:
+            moves.append((file, destination))
+
+    # Move test reports into toplevel directory
+    for file, destination in moves:
         file.rename(destination)
 
+    # The test results are fixed up and moved on all cores
+    print(f'Processing {len(result_tasks)} test results')
+    rewritten = 0
+    if len(result_tasks) != 0:
+        with mp.Pool() as pool:
+            rewritten = sum(pool.imap_unordered(process_allure_result, result_tasks, chunksize=64))
+
+    print(f'Processed {len(result_tasks)} test results, rewrote {rewritten}, moved {len(moves)} other files into {str(allure_report_dir)}')
+
+def percentile(sorted_values: list, percent: float):
+    # Nearest-rank percentile of an already sorted list
+    if len(sorted_values) == 0:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+def summarize_allure_results(allure_report_dir: pathlib.Path, images_by_test_source: dict, services_by_test_source: dict) -> dict:
+    # Stream the processed test results one at a time, and tally them up by image, test class and service. The test
+    # source (parentSuite) and test class (suite) labels are the ones set by process_allure_reports.
+    statuses = ["passed", "failed", "broken", "skipped", "unknown"]
+    groups = {"image": {}, "test_class": {}, "service": {}}
+    durations = {"image": {}, "test_class": {}, "service": {}}
+
+    # There are no results when the tests were skipped
+    entries = os.scandir(allure_report_dir) if allure_report_dir.exists() else []
+    for entry in entries:
+        if not entry.is_file() or not entry.name.endswith("result.json"):
+            continue
+
+        with open(entry.path, 'r') as f:
+            test_result = json.load(f)
+
+        labels = {label["name"]: label["value"] for label in test_result.get("labels", [])}
+        test_source = labels.get("parentSuite", "unknown")
+        keys = {
+            "image": images_by_test_source.get(test_source, test_source),
+            "test_class": labels.get("suite", "unknown"),
+            "service": services_by_test_source.get(test_source, "unknown"),
+        }
+
+        status = test_result.get("status", "unknown")
+        if status not in statuses:
+            status = "unknown"
+
+        duration = None
+        if "start" in test_result and "stop" in test_result:
+            duration = test_result["stop"] - test_result["start"]
+
+        for group, key in keys.items():
+            if key not in groups[group]:
+                groups[group][key] = {"tests": 0, **{status: 0 for status in statuses}}
+                durations[group][key] = []
+
+            groups[group][key]["tests"] += 1
+            groups[group][key][status] += 1
+            if duration is not None:
+                durations[group][key].append(duration)
+
+    summary = {}
+    for group, counts_by_key in groups.items():
+        summary[f'by_{group}'] = {}
+        for key in sorted(counts_by_key):
+            key_durations = sorted(durations[group][key])
+            summary[f'by_{group}'][key] = {
+                **counts_by_key[key],
+                "duration_ms": {
+                    "total": sum(key_durations),
+                    "p50": percentile(key_durations, 50),
+                    "p95": percentile(key_durations, 95),
+                }
+            }
+
+    return summary
+
+def print_test_summary(summary: dict):
+    def seconds(duration_ms):
+        return "-" if duration_ms is None else f'{duration_ms / 1000:.1f}'
+
+    for group, title in [("by_image", "Image"), ("by_test_class", "Test class"), ("by_service", "Service")]:
+        rows = [[title, "Tests", "Passed", "Failed", "Broken", "Skipped", "Unknown", "Total (s)", "p50 (s)", "p95 (s)"]]
+        for key, result in summary[group].items():
+            rows.append([
+                key, str(result["tests"]), str(result["passed"]), str(result["failed"]), str(result["broken"]), str(result["skipped"]), str(result["unknown"]),
+                seconds(result["duration_ms"]["total"]), seconds(result["duration_ms"]["p50"]), seconds(result["duration_ms"]["p95"])
+            ])
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        print()
+        for i, row in enumerate(rows):
+            print("  ".join([row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]))
+            if i == 0:
+                print("  ".join("-" * width for width in widths))
+
 if __name__ == "__main__":
     #
     # Parse CLI flags
     #
     parser = argparse.ArgumentParser()
     parser.add_argument("--csm-extractor-output-json", type=str, default="csm-manifest-extractor-output.json", help="Read in the json file created by the csm_manifest_extractor.py")
+    parser.add_argument("--csm-extractor-output-db", type=str, default=None, help="Read in the SQLite database created by the csm_manifest_extractor.py instead of --csm-extractor-output-json")
     parser.add_argument("--csm-release", type=str, default="main", help="CSM release branch to target")
     parser.add_argument("--test-config-global", type=str, default="test_config_global.yaml",  help="Global test configuration file")
 
     parser.add_argument("--allure-dir", type=str, default="./allure",  help="Allure output director")
     parser.add_argument("--fix-allure-dir-perms", type=bool, default=False, action=argparse.BooleanOptionalAction, help="Correct file permissions of allure test report files when running in github actions")
+    parser.add_argument("--test-workers", type=int, default=4, help="Max number of test containers to run at the same time, for the test classes listed in concurrent_test_classes of the global test config")
+    parser.add_argument("--warm-containers", type=bool, default=False, action=argparse.BooleanOptionalAction, help="Start one container per test image and run each of its test suites in it with docker exec, instead of a new container per test suite")
+    parser.add_argument("--test-summary", type=str, default="test_summary.json", help="File to write the pass/fail counts and durations of the tests by image, test class and service to")
     parser.add_argument("--tests-output-dir", type=str, default="./tests",  help="Directory to store tests")
     
+    parser.add_argument("--discovery-backend", type=str, default="subtree", choices=["subtree", "export", "layers"], help="How tests are discovered in test images. 'subtree' only copies /src/app out of the image, 'export' lists the entire filesystem of the image, 'layers' lists each image layer once and keeps it in --layer-index-dir")
+    parser.add_argument("--layer-index-dir", type=str, default="./.cache/layer-index", help="Directory to keep the files of each image layer in, for the 'layers' discovery backend")
+    parser.add_argument("--discovery-cache", type=str, default=None, help="File to cache the tests discovered in each test image in between runs, keyed by image ID")
+    parser.add_argument("--pull-workers", type=int, default=4, help="Max number of test images to pull at the same time")
+    parser.add_argument("--pull-retries", type=int, default=2, help="Number of times to retry pulling a test image before giving up")
     parser.add_argument("--skip-pull", type=bool, default=False, action=argparse.BooleanOptionalAction, help="Skipping pulling of images. For local dev only")
     parser.add_argument("--skip-tests", type=bool, default=False, action=argparse.BooleanOptionalAction, help="Skipping running of tests. For local dev only")
 
@@ -234,16 +877,13 @@ if __name__ == "__main__":
     # Load configuration
     #
 
-    # Read in the json file created by the csm_manifest_extractor.py
-    csm_extractor_output = None
-    with open(args.csm_extractor_output_json, 'r') as f:
-        csm_extractor_output = json.load(f)
-
-    if args.csm_release not in csm_extractor_output:
-        print(f'Error provided CSM release does not exist in {args.csm_extractor_output_json}')
+    # Read in the CSM release from the output of the csm_manifest_extractor.py
+    csm_release = csm_image_store.load_release(args.csm_release, args.csm_extractor_output_json, args.csm_extractor_output_db)
+    if csm_release is None:
+        print(f'Error provided CSM release does not exist in {args.csm_extractor_output_db or args.csm_extractor_output_json}')
         exit(1)
 
-    images = csm_extractor_output[args.csm_release]["images"]
+    images = csm_release["images"]
 
     # Global test config
     test_config_global = None
@@ -264,6 +904,8 @@ if __name__ == "__main__":
     # Directories
     allure_dir = pathlib.Path(args.allure_dir)
     tests_output_dir = pathlib.Path(args.tests_output_dir)
+    discovery_cache_path = pathlib.Path(args.discovery_cache) if args.discovery_cache is not None else None
+    layer_index_dir = pathlib.Path(args.layer_index_dir)
 
     #
     # Identify test images
@@ -279,10 +921,10 @@ if __name__ == "__main__":
     #
     # Pull required images
     #
+    ready_images = hmth_images
     if not args.skip_pull:
-        for image in hmth_images:
-            print("Pulling", image)
-            docker_client.images.pull(image)
+        # Pulled lazily, while tests are being detected in the images that have already been pulled
+        ready_images = pull_images(docker_client, hmth_images, args.pull_workers, args.pull_retries)
 
     #
     # Detect tests from test images
@@ -306,7 +948,7 @@ if __name__ == "__main__":
         "src/app/tavern_global_config_ct_production.yaml": "production-other",
         "src/app/tavern_global_config_ct_test_emulated_hardware.yaml": "emulated-hardware",
         "src/app/tavern_global_config_ct_test_environment.yaml": "test-environment",
-    })
+    }, discovery_backend=args.discovery_backend, discovery_cache_path=discovery_cache_path, layer_index_dir=layer_index_dir, ready_images=ready_images)
     
     tests = []
     for test_filter in test_config_global["test_order"]: 
@@ -337,7 +979,7 @@ if __name__ == "__main__":
     # Run tests
     #
     if not args.skip_tests:
-        run_tests(test_config_global, detected_tavern_configs, tests, allure_dir)
+        run_tests(docker_client, test_config_global, detected_tavern_configs, tests, allure_dir, args.test_workers, args.warm_containers)
 
         if args.fix_allure_dir_perms:
             print("Correcting allure report file perms.")
@@ -360,7 +1002,22 @@ if __name__ == "__main__":
     # Display summary
     #
 
-    # TODO look at the allure files and output a simple pass/fail count based on image
+    # The allure results are named after the short name of the image repo
+    images_by_test_source = {}
+    services_by_test_source = {}
+    for image in hmth_images:
+        image_repo = image.split(":", 2)[0]
+        images_by_test_source[os.path.basename(image_repo)] = image
+        if image_repo in image_repo_service_lookup:
+            services_by_test_source[os.path.basename(image_repo)] = image_repo_service_lookup[image_repo]
+
+    test_summary = summarize_allure_results(allure_dir, images_by_test_source, services_by_test_source)
+    print_test_summary(test_summary)
+
+    with open(args.test_summary, 'w') as f:
+        json.dump(test_summary, f, indent=2)
+    print()
+    print(f'Wrote test summary to {args.test_summary}')
 
     print()
     print('View allure report locally')
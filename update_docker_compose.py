@@ -25,30 +25,29 @@
 import argparse
 import os
 import sys
-import json
 import subprocess
 import yaml
 
+import csm_image_store
+
 # TODO expand to use data from test_global_config.yaml
 
 # Parse CLI arguments
 parser = argparse.ArgumentParser()
 parser.add_argument("--csm-extractor-output-json", type=str, default="csm-manifest-extractor-output.json", help="Read in the json file created by the csm_manifest_extractor.py")
+parser.add_argument("--csm-extractor-output-db", type=str, default=None, help="Read in the SQLite database created by the csm_manifest_extractor.py instead of --csm-extractor-output-json")
 parser.add_argument("--csm-release", type=str, default="main", help="CSM release branch to target")
 parser.add_argument("--docker-compose-file", type=str, default="./hms-simulation-environment/docker-compose.yaml", help="Path to the HMS Simulation Environment docker-compose.yaml file to update")
 
 args = parser.parse_args()
 
-# Read in the json file created by the csm_manifest_extractor.py
-csm_extractor_output = None
-with open(args.csm_extractor_output_json, 'r') as f:
-    csm_extractor_output = json.load(f)
-
-if args.csm_release not in csm_extractor_output:
-    print(f'Error provided CSM release does not exist in {args.csm_extractor_output_json}')
+# Read in the CSM release from the output of the csm_manifest_extractor.py
+csm_release = csm_image_store.load_release(args.csm_release, args.csm_extractor_output_json, args.csm_extractor_output_db)
+if csm_release is None:
+    print(f'Error provided CSM release does not exist in {args.csm_extractor_output_db or args.csm_extractor_output_json}')
     exit(1)
 
-image_overrides = csm_extractor_output[args.csm_release]["images"]
+image_overrides = csm_release["images"]
 
 # Read in the docker-compose file
 docker_compose = None